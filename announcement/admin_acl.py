@@ -0,0 +1,49 @@
+from typing import Any, Dict, FrozenSet, Iterable, Mapping, Optional, Tuple
+from typing import TYPE_CHECKING
+
+if TYPE_CHECKING:
+    from announcement.recipient_lists import RecipientGroups
+
+
+class AdminAcl:
+    """Immutable admin -> general users lookup compiled from the `admins` config section.
+
+    A new instance is built whenever the config changes and swapped in as a
+    whole, so event handlers never see a half-updated table. The general
+    users of an admin include the members of the "+group" entries in their
+    list as well as the entries themselves.
+    """
+
+    __slots__ = ("_general", "_general_lists")
+
+    def __init__(self, admin_config: Iterable[Mapping[str, Any]] = (), groups: Optional['RecipientGroups'] = None):
+        general: Dict[str, FrozenSet[str]] = {}
+        general_lists: Dict[str, Tuple[str, ...]] = {}
+        for admin in admin_config or ():
+            user = admin.get("user") if isinstance(admin, Mapping) else None
+            if not user:
+                continue
+            users = tuple(admin.get("general") or ())
+            general[user] = frozenset(users).union(groups.expand(users) if groups else ())
+            general_lists[user] = users
+        self._general = general
+        self._general_lists = general_lists
+
+    def __len__(self) -> int:
+        return len(self._general)
+
+    def __contains__(self, user_id: str) -> bool:
+        return user_id in self._general
+
+    def is_admin(self, user_id: str) -> bool:
+        return user_id in self._general
+
+    def admins(self) -> FrozenSet[str]:
+        return frozenset(self._general)
+
+    def general_users(self, admin_id: str) -> Tuple[str, ...]:
+        """Return the general users of an admin in config order."""
+        return self._general_lists.get(admin_id, ())
+
+    def is_general_user(self, admin_id: str, user_id: str) -> bool:
+        return user_id in self._general.get(admin_id, ())
@@ -1,24 +1,59 @@
 from maubot import MessageEvent, Plugin
-from maubot.handlers import event
+from maubot.handlers import event, web
+from aiohttp.web import Request, Response
 from mautrix.types import EventType, StateEvent
 from mautrix.util.config import BaseProxyConfig, ConfigUpdateHelper
 from typing import Type
+import logging
+import time
+from mautrix.util.async_db import UpgradeTable
 from mautrix.types import PaginationDirection, Membership
 import asyncio
-from collections import deque
 from announcement.queu_processor import QueueProcessor
-from announcement.room_manager import RoomManager
+from announcement.room_manager import RoomManager, ANNOUNCEMENT_STATE_EVENT
+from announcement.room_index import RoomIndex
+from announcement.admin_acl import AdminAcl
+from announcement.state_propagator import StatePropagator
+from announcement.provisioner import RoomProvisioner
+from announcement.db import upgrade_table
+from announcement.metrics import Metrics
+from announcement.rate_limiter import keep_retry_after
+from announcement.recipient_lists import LIVE, RecipientGroups, shard_entries
 
 # Define state event types
 NAME_STATE_EVENT = EventType.find("m.room.name", EventType.Class.STATE)
 TOPIC_STATE_EVENT = EventType.find("m.room.topic", EventType.Class.STATE)
 AVATAR_STATE_EVENT = EventType.find("m.room.avatar", EventType.Class.STATE)
 REDACT_TIMELINE_EVENT = EventType.find("org.minbh.announcement", EventType.Class.MESSAGE)
+RECEIVER_STATE_EVENT = EventType.find("org.minbh.announcement.receiver", EventType.Class.STATE)
 
 # Configuration class for the bot
 class Config(BaseProxyConfig):
     def do_update(self, helper: ConfigUpdateHelper) -> None:
         helper.copy("admins")
+        helper.copy("groups")
+        helper.copy("shard_size")
+        helper.copy("state_cache_size")
+        helper.copy("fanout_concurrency")
+        helper.copy("room_creation.per_second")
+        helper.copy("room_creation.burst")
+        helper.copy("room_creation.max_retries")
+        helper.copy("send_workers")
+        helper.copy("send_partitioning")
+        helper.copy("bulk_windows")
+        helper.copy("reconcile_concurrency")
+        helper.copy("state_debounce")
+        helper.copy("preprovision.enabled")
+        helper.copy("preprovision.per_second")
+        helper.copy("rate_limit.per_second")
+        helper.copy("rate_limit.burst")
+        helper.copy("rate_limit.max_backoff")
+        helper.copy("senders")
+        helper.copy("persistent_queue")
+        helper.copy("receipts.window")
+        helper.copy("receipts.batch")
+        helper.copy("receipts.edit_in_place")
+        helper.copy("receipts.max_listed")
 
 # Main bot plugin class
 class Announcement(Plugin):
@@ -27,15 +62,44 @@ class Announcement(Plugin):
         """Start the plugin and load configuration."""
         await super().start()
         self.config.load_and_update()
-        self.message_queue = deque()
-        self.high_priority_queue = deque()
-        self.lock = asyncio.Lock()
-        self.rate_limit_per_second = 0.9 
-        self.sleep_time = 1 / self.rate_limit_per_second
+        keep_retry_after(self.client.api)
+        self.admin_acl = AdminAcl(self.config.get("admins", []), RecipientGroups(self.config.get("groups", {})))
+        self.metrics = Metrics(self)
+        self.fanout_semaphore = asyncio.Semaphore(self.config.get("fanout_concurrency", 10))
         self.queue_processor = QueueProcessor(self)
         self.room_manager = RoomManager(self)
+        self.room_index = RoomIndex(self)
+        await self.queue_processor.senders.start()
+        await self.room_manager.warm_room_index()
+        await self.queue_processor.restore()
+        self.queue_processor.start()
+        self.state_propagator = StatePropagator(self)
+        self.provisioner = RoomProvisioner(self)
+        self.provisioner.start()
+        # Index receiver rooms and reconcile announcement rooms in the background so messages are handled right away
+        self.reconcile_task = asyncio.create_task(self.reconcile())
+
+    async def reconcile(self) -> None:
+        # Receiver rooms are skipped using the index, so build it first on a cold start
+        await self.room_manager.build_room_index()
         await self.room_manager.update_room_general_members(self.config)
-        asyncio.create_task(self.queue_processor.process_queue())
+
+    async def stop(self) -> None:
+        self.reconcile_task.cancel()
+        await asyncio.gather(self.reconcile_task, return_exceptions=True)
+        self.state_propagator.stop()
+        self.provisioner.stop()
+        await self.queue_processor.stop()
+
+    @web.get("/metrics")
+    async def metrics_endpoint(self, request: Request) -> Response:
+        """Expose delivery metrics in the Prometheus text format."""
+        return Response(text=self.metrics.render(), content_type="text/plain",
+                        headers={"Cache-Control": "no-store"})
+
+    @event.on(EventType.ALL)
+    async def handle_any_event(self, evt: MessageEvent) -> None:
+        self.room_manager.update_state_cache(evt)
 
     @event.on(EventType.ROOM_POWER_LEVELS)
     async def handle_power_event(self, evt: MessageEvent) -> None:
@@ -48,14 +112,42 @@ class Announcement(Plugin):
           if  self.is_invite_and_not_direct(evt):
                 await self.client.join_room(evt.room_id)
 
+    @event.on(EventType.ROOM_MEMBER)
+    async def handle_receiver_room_member(self, evt: StateEvent) -> None:
+        await self.room_manager.update_room_index_from_member(evt)
+
+    @event.on(RECEIVER_STATE_EVENT)
+    async def handle_receiver_state_event(self, evt: StateEvent) -> None:
+        await self.room_manager.update_room_index_from_receiver(evt)
+
+    @event.on(ANNOUNCEMENT_STATE_EVENT)
+    async def handle_announcement_state_event(self, evt: StateEvent) -> None:
+        if evt.sender == self.client.mxid or self.is_bot_privileged(evt):
+            live_entries = shard_entries(LIVE, evt.state_key, evt.content)
+            if live_entries is not None:
+                self.provisioner.live_changed(evt.room_id, evt.state_key, live_entries)
+
     @event.on(EventType.ROOM_REDACTION)
     async def handle_message_redact_event(self, evt: MessageEvent) -> None:
-        self.log.warning(f"Event received of type: {evt.type}")
         if self.is_bot_privileged(evt):
-            room_state = await self.room_manager.fetch_room_state(evt.room_id)
-            allowed_users = self.room_manager.extract_annoucment_members(room_state)
-            self.log.warning(f"redacted event id {evt.redacts}")
+            self.log.debug(f"redacted event id {evt.redacts}")
+            # Recall copies that haven't been sent yet first, so nothing new is delivered after the lookup below
+            progress = self.queue_processor.receipts.get(evt.redacts)
+            recalled = await self.queue_processor.recall(evt.redacts)
+            forwarded = await self.queue_processor.forwarded_events.get(evt.redacts)
+            if progress and progress.receipt_event_id:
+                forwarded.append((progress.origin_room_id, progress.receipt_event_id, None))
+            if forwarded:
+                # Queued so rate limited redactions are retried; each record is dropped once its copy is redacted
+                for room_id, event_id, _ in forwarded:
+                    self.queue_processor.enqueue_redaction(evt.redacts, room_id, event_id)
+                return
+            if recalled:
+                return
 
+            # Announcements delivered before forwarded events were recorded need a history scan
+            room_state = await self.room_manager.fetch_room_state(evt.room_id)
+            allowed_users = room_state.live_users
             for user in allowed_users:
                 existing_room_id = await self.room_manager.get_existing_private_room(evt.room_id, user)
                 if existing_room_id:
@@ -63,45 +155,75 @@ class Announcement(Plugin):
 
     @event.on(EventType.ROOM_MESSAGE)
     async def handle_message_event(self, evt: MessageEvent) -> None:
-        self.log.warning(f"Event received of type: {evt.type}")
         if self.is_bot_privileged(evt):
+            if evt.content.get_edit():
+                await self.announce_edit_to_allowed_users(evt)
+                return
             room_state = await self.room_manager.fetch_room_state(evt.room_id)
-            allowed_users = self.room_manager.extract_annoucment_members(room_state)
-            allowed_users_str = ', '.join(allowed_users)
-            self.log.warning(f"annoucement members {allowed_users_str}")
+            allowed_users = room_state.live_users
+            if self.log.isEnabledFor(logging.DEBUG):
+                self.log.debug(f"annoucement members {', '.join(allowed_users)}")
             evt.content["origin_event_id"] = evt.event_id
             await self.client.send_receipt(evt.room_id, evt.event_id, "m.read")
             await self.announce_message_to_allowed_users(evt, allowed_users, evt.room_id, room_state)
 
     async def announce_message_to_allowed_users(self, evt: MessageEvent, allowed_users, announcement_room_id, room_state):
         """Announce messages to allowed users in private rooms."""
-        for user in allowed_users:
-            private_room_id = await self.room_manager.create_or_join_private_room(user, announcement_room_id, room_state)
-            if private_room_id:
-                message = {
-                    "origin_room_id": evt.room_id,
-                    "origin_evt_id": evt.event_id,
-                    "room_id": private_room_id,
-                    "content": evt.content,
-                    "user": user
-                }
-                self.log.warning(f"Will announce to allowed user {user}")
-                async with self.lock:
-                     self.message_queue.append(message) 
+        if self.queue_processor.outbox:
+            # Skip users this broadcast was already queued for, e.g. when the event is handled again after a restart
+            already_queued = await self.queue_processor.outbox.recipients(evt.event_id)
+            allowed_users = [user for user in allowed_users if user not in already_queued]
+        self.queue_processor.receipts.expect(evt.room_id, evt.event_id, allowed_users)
+        await asyncio.gather(*(
+            self.announce_message_to_user(evt, user, announcement_room_id, room_state)
+            for user in allowed_users
+        ))
+
+    async def announce_message_to_user(self, evt: MessageEvent, user, announcement_room_id, room_state):
+        """Resolve the private room of one user and queue the message as soon as it is ready."""
+        async with self.fanout_semaphore:
+            started = time.perf_counter()
+            try:
+                private_room_id = await self.room_manager.create_or_join_private_room(user, announcement_room_id,
+                                                                                      room_state)
+            except Exception as e:
+                self.log.error(f"Failed to resolve the receiver room of {user}: {e}")
+                private_room_id = None
+            self.metrics.room_lookup_seconds.observe(time.perf_counter() - started,
+                                                     result="ok" if private_room_id else "failed")
+        if private_room_id:
+            message = {
+                "origin_room_id": evt.room_id,
+                "origin_evt_id": evt.event_id,
+                "room_id": private_room_id,
+                "content": evt.content,
+                "user": user
+            }
+            self.log.debug(f"Will announce to allowed user {user}")
+            self.queue_processor.enqueue(message, self.queue_processor.broadcast_priority(evt.content))
+        else:
+            self.queue_processor.receipts.failed({"origin_evt_id": evt.event_id, "user": user})
 
 
+    async def announce_edit_to_allowed_users(self, evt: MessageEvent) -> None:
+        """Replace the forwarded copies of an edited announcement and send the queued ones edited."""
+        original_event_id = evt.content.get_edit()
+        content = evt.content.serialize()
+        content["m.new_content"]["origin_event_id"] = original_event_id
+        await self.queue_processor.edit(original_event_id, evt.event_id, content)
+        forwarded = await self.queue_processor.forwarded_events.get(original_event_id)
+        if not forwarded:
+            self.log.debug(f"No forwarded copies of {original_event_id} to edit")
+            return
+        for room_id, event_id, sender in forwarded:
+            self.queue_processor.enqueue_edit(evt.room_id, evt.event_id, original_event_id, room_id, event_id,
+                                              sender, content)
+
     async def handle_state_event(self, evt: StateEvent) -> None:
         """Handle state events (name, topic, avatar)."""
         if self.is_bot_privileged(evt):
-            room_state = await self.room_manager.fetch_room_state(evt.room_id)
-            allowed_users = self.room_manager.extract_annoucment_members(room_state)
             self.log.debug(f"Event received of type: {evt.type}")
-            self.log.debug(f"Allowed users count: {len(allowed_users)}")
-
-            for user in allowed_users:
-                existing_room_id = await self.room_manager.get_existing_private_room(evt.room_id, user)
-                if existing_room_id:
-                    await self.client.send_state_event(existing_room_id, evt.type, evt.content)
+            self.state_propagator.schedule(evt.room_id, str(evt.type), evt.content.serialize())
 
     async def get_and_redact_messages(self, room_id: str,  redact_event_id: str, limit: int = 5): 
 
@@ -136,12 +258,12 @@ class Announcement(Plugin):
                 #reference set send in the message when sending the message by bot
                 origin_event_id = getattr(decrypted_event.content, 'origin_event_id', None)
                 origin_body = getattr(decrypted_event.content, 'body', None)
-                self.log.warning(f"origin_event_id : {origin_event_id} vs {redact_event_id} body: {origin_body}")
+                self.log.debug(f"origin_event_id : {origin_event_id} vs {redact_event_id} body: {origin_body}")
 
                 if origin_event_id is not None:
                     if origin_event_id == redact_event_id:
                         redacted = await self.client.redact(room_id=room_id, event_id=event.event_id) 
-                        self.log.warning(f"Redacted event: {redacted}")
+                        self.log.debug(f"Redacted event: {redacted}")
             except Exception as e:
                 self.log.warning(f"Error redacting event {event.event_id}: {e}")
 
@@ -162,20 +284,30 @@ class Announcement(Plugin):
     async def check_avatar_event(self, evt: StateEvent) -> None:
         await self.handle_state_event(evt)
 
+    def on_external_config_update(self) -> None:
+        super().on_external_config_update()
+        # Swap in a freshly compiled table; handlers keep using the old one until this assignment
+        groups = RecipientGroups(self.config.get("groups", {}))
+        self.admin_acl = AdminAcl(self.config.get("admins", []), groups)
+        self.room_manager.groups = groups
+        # Cached room state expanded the old groups
+        self.room_manager.state_cache.clear()
+
     @classmethod
     def get_config_class(cls) -> Type[BaseProxyConfig]:
         return Config
+
+    @classmethod
+    def get_db_upgrade_table(cls) -> UpgradeTable:
+        return upgrade_table
     
     def is_bot_privileged(self, evt: MessageEvent) -> bool:
-        admin_users = self.room_manager.get_admin_users(self.config)
-        self.log.debug(f"admin members {admin_users}")
-        self.log.debug(f"Event received of type: {evt.type}")
-        if evt.sender in admin_users:
-          return True
-        return False
+        if self.log.isEnabledFor(logging.DEBUG):
+            self.log.debug(f"Event received of type: {evt.type} from {evt.sender}")
+        return self.admin_acl.is_admin(evt.sender)
     
     def is_invite_and_not_direct(self, evt: MessageEvent) -> bool:
-        self.log.warning(f"Entire membership event: {evt}")
+        self.log.debug(f"Entire membership event: {evt}")
         
         # Extract membership and is_direct values
         membership = evt.get("content", {}).get("membership")
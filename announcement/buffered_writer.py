@@ -0,0 +1,59 @@
+import asyncio
+from typing import Awaitable, Optional, Set
+from typing import TYPE_CHECKING
+
+if TYPE_CHECKING:
+    from announcement.bot import Announcement
+
+
+class BufferedWriter:
+    """Base for database tables written in batches.
+
+    Subclasses buffer their writes, report how many are waiting in
+    _buffered() and write them in _write(). A flush runs once batch_size
+    writes are waiting or flush_interval seconds after the first one.
+    """
+
+    def __init__(self, announcement: 'Announcement', flush_interval: float = 0.5, batch_size: int = 500):
+        self.announcement = announcement
+        self.database = announcement.database
+        self.log = announcement.log
+        self.flush_interval = flush_interval
+        self.batch_size = batch_size
+        self._flush_task: Optional[asyncio.Task] = None
+        self._flush_lock = asyncio.Lock()
+        self._tasks: Set[asyncio.Task] = set()
+
+    def _buffered(self) -> int:
+        raise NotImplementedError
+
+    async def _write(self) -> None:
+        """Write the buffered rows. Called with the flush lock held."""
+        raise NotImplementedError
+
+    def _schedule_flush(self) -> None:
+        if self._buffered() >= self.batch_size:
+            self._start(self.flush())
+        elif self._flush_task is None or self._flush_task.done():
+            self._flush_task = self._start(self._delayed_flush())
+
+    def _start(self, coro: Awaitable[None]) -> asyncio.Task:
+        task = asyncio.ensure_future(coro)
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+        return task
+
+    async def _delayed_flush(self) -> None:
+        await asyncio.sleep(self.flush_interval)
+        await self.flush()
+
+    async def flush(self) -> None:
+        """Write everything buffered so far."""
+        async with self._flush_lock:
+            await self._write()
+
+    async def close(self) -> None:
+        """Flush the buffer and stop the flushes still scheduled."""
+        await self.flush()
+        for task in self._tasks:
+            task.cancel()
@@ -0,0 +1,50 @@
+from mautrix.util.async_db import Connection, UpgradeTable
+
+upgrade_table = UpgradeTable()
+
+
+@upgrade_table.register(description="Receiver room index")
+async def upgrade_v1(conn: Connection) -> None:
+    await conn.execute(
+        """CREATE TABLE receiver_room (
+            room_id           TEXT PRIMARY KEY,
+            announcement_room TEXT NOT NULL,
+            user_id           TEXT NOT NULL,
+            sender            TEXT,
+            UNIQUE (announcement_room, user_id)
+        )"""
+    )
+
+
+@upgrade_table.register(description="Persistent delivery outbox")
+async def upgrade_v2(conn: Connection) -> None:
+    await conn.execute(
+        """CREATE TABLE outbox (
+            origin_evt_id  TEXT NOT NULL,
+            user_id        TEXT NOT NULL,
+            origin_room_id TEXT NOT NULL,
+            room_id        TEXT NOT NULL,
+            content        TEXT NOT NULL,
+            priority       INTEGER NOT NULL,
+            status         TEXT NOT NULL DEFAULT 'pending',
+            event_id       TEXT,
+            created_at     BIGINT NOT NULL,
+            PRIMARY KEY (origin_evt_id, user_id)
+        )"""
+    )
+    await conn.execute("CREATE INDEX outbox_status_idx ON outbox (status)")
+
+
+@upgrade_table.register(description="Origin to forwarded event mapping")
+async def upgrade_v3(conn: Connection) -> None:
+    await conn.execute(
+        """CREATE TABLE forwarded_event (
+            origin_evt_id TEXT NOT NULL,
+            room_id       TEXT NOT NULL,
+            event_id      TEXT NOT NULL,
+            user_id       TEXT NOT NULL,
+            created_at    BIGINT NOT NULL,
+            sender        TEXT,
+            PRIMARY KEY (origin_evt_id, room_id)
+        )"""
+    )
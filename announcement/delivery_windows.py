@@ -0,0 +1,57 @@
+from datetime import datetime, timezone
+from typing import Iterable, List, Optional, Tuple
+
+MINUTES_PER_DAY = 24 * 60
+
+
+def parse_window(spec: str) -> Tuple[int, int]:
+    """Parse "HH:MM-HH:MM" into (start, end) minutes of the day.
+
+    Windows may wrap past midnight, and one that ends where it starts covers the whole day.
+    """
+    start, sep, end = spec.partition("-")
+    if not sep:
+        raise ValueError(f"invalid delivery window {spec!r}, expected HH:MM-HH:MM")
+    return parse_time(start), parse_time(end)
+
+
+def parse_time(value: str) -> int:
+    hours, sep, minutes = value.strip().partition(":")
+    if not sep or not hours.isdigit() or not minutes.isdigit() or int(hours) > 23 or int(minutes) > 59:
+        raise ValueError(f"invalid time {value!r}, expected HH:MM")
+    return int(hours) * 60 + int(minutes)
+
+
+class DeliveryWindows:
+    """Daily UTC time windows during which bulk broadcasts may be sent. No windows means always open."""
+
+    def __init__(self, specs: Iterable[str] = ()):
+        self.windows: List[Tuple[int, int]] = [parse_window(spec) for spec in specs or ()]
+
+    def __bool__(self) -> bool:
+        return bool(self.windows)
+
+    def is_open(self, now: Optional[datetime] = None) -> bool:
+        if not self.windows:
+            return True
+        minute = self._minute_of_day(now)
+        for start, end in self.windows:
+            if start == end:
+                return True
+            if start < end:
+                if start <= minute < end:
+                    return True
+            elif minute >= start or minute < end:
+                return True
+        return False
+
+    def seconds_until_change(self, now: Optional[datetime] = None) -> float:
+        """Return the seconds until the next window boundary, where is_open() may change."""
+        minute = self._minute_of_day(now)
+        boundaries = [boundary for window in self.windows for boundary in window]
+        return min((boundary - minute) % MINUTES_PER_DAY or MINUTES_PER_DAY for boundary in boundaries) * 60
+
+    @staticmethod
+    def _minute_of_day(now: Optional[datetime]) -> float:
+        now = now or datetime.now(timezone.utc)
+        return now.hour * 60 + now.minute + now.second / 60 + now.microsecond / 60_000_000
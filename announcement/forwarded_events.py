@@ -0,0 +1,75 @@
+import time
+from mautrix.types import EventID, RoomID
+from typing import Any, List, Optional, Tuple
+from typing import TYPE_CHECKING
+
+from announcement.buffered_writer import BufferedWriter
+
+if TYPE_CHECKING:
+    from announcement.bot import Announcement
+
+
+class ForwardedEvents(BufferedWriter):
+    """Persistent origin event -> [(receiver room, forwarded event, sender)] map, written in batches.
+
+    The sender is the extra account a copy was sent from, or None for the bot,
+    so edits can be sent by the same account as the copy they replace.
+
+    Rows older than retention_days are pruned at start-up; announcements that
+    old are no longer edited or redacted through this map.
+    """
+
+    def __init__(self, announcement: 'Announcement', flush_interval: float = 0.5, batch_size: int = 500,
+                 retention_days: int = 7):
+        super().__init__(announcement, flush_interval, batch_size)
+        self.retention_days = retention_days
+        self._pending: List[Tuple[Any, ...]] = []
+        self._removed: List[Tuple[Any, ...]] = []
+
+    def add(self, origin_evt_id: EventID, room_id: RoomID, event_id: EventID, user_id: str,
+            sender: Optional[str] = None) -> None:
+        """Record the copy of an origin event that was delivered to a receiver room."""
+        self._pending.append((origin_evt_id, room_id, event_id, user_id, int(time.time() * 1000), sender))
+        self._schedule_flush()
+
+    def remove_copy(self, origin_evt_id: EventID, room_id: RoomID) -> None:
+        """Forget one copy of an origin event, e.g. once it was redacted."""
+        self._removed.append((origin_evt_id, room_id))
+        self._schedule_flush()
+
+    async def get(self, origin_evt_id: EventID) -> List[Tuple[RoomID, EventID, Optional[str]]]:
+        """Return every (receiver room, forwarded event ID, sender) delivered for an origin event."""
+        await self.flush()
+        rows = await self.database.fetch(
+            "SELECT room_id, event_id, sender FROM forwarded_event WHERE origin_evt_id=$1", origin_evt_id
+        )
+        return [(row["room_id"], row["event_id"], row["sender"]) for row in rows]
+
+    async def prune(self) -> None:
+        cutoff = int((time.time() - self.retention_days * 24 * 60 * 60) * 1000)
+        await self.database.execute("DELETE FROM forwarded_event WHERE created_at<$1", cutoff)
+
+    def _buffered(self) -> int:
+        return len(self._pending) + len(self._removed)
+
+    async def _write(self) -> None:
+        pending, self._pending = self._pending, []
+        removed, self._removed = self._removed, []
+        if not pending and not removed:
+            return
+        try:
+            async with self.database.acquire() as conn, conn.transaction():
+                if pending:
+                    await conn.executemany(
+                        "INSERT INTO forwarded_event (origin_evt_id, room_id, event_id, user_id, created_at, sender) "
+                        "VALUES ($1, $2, $3, $4, $5, $6) ON CONFLICT (origin_evt_id, room_id) DO NOTHING",
+                        pending,
+                    )
+                if removed:
+                    await conn.executemany(
+                        "DELETE FROM forwarded_event WHERE origin_evt_id=$1 AND room_id=$2", removed
+                    )
+        except Exception as e:
+            self.log.error(f"Failed to record forwarded events: {e}")
+            self._pending = pending + self._pending
+            self._removed = removed + self._removed
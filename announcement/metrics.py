@@ -0,0 +1,196 @@
+import bisect
+import time
+from collections import deque
+from typing import Deque, Dict, Iterable, List, Tuple
+from typing import TYPE_CHECKING
+
+if TYPE_CHECKING:
+    from announcement.bot import Announcement
+
+LabelKey = Tuple[Tuple[str, str], ...]
+
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+BACKOFF_BUCKETS = (0.5, 1, 2, 5, 10, 30, 60, 120)
+BROADCAST_BUCKETS = (1, 5, 15, 30, 60, 300, 900, 1800, 3600)
+
+
+def label_key(labels: Dict[str, str]) -> LabelKey:
+    return tuple(sorted((name, str(value)) for name, value in labels.items()))
+
+
+def format_labels(key: LabelKey) -> str:
+    if not key:
+        return ""
+    return "{" + ",".join(
+        f'{name}="' + value.replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"') + '"'
+        for name, value in key
+    ) + "}"
+
+
+def format_value(value: float) -> str:
+    if value == float("inf"):
+        return "+Inf"
+    return repr(float(value)) if isinstance(value, float) and not value.is_integer() else str(int(value))
+
+
+class Counter:
+    kind = "counter"
+
+    def __init__(self, name: str, help_text: str):
+        self.name = name
+        self.help_text = help_text
+        self.values: Dict[LabelKey, float] = {}
+
+    def inc(self, amount: float = 1, **labels: str) -> None:
+        key = label_key(labels)
+        self.values[key] = self.values.get(key, 0) + amount
+
+    def samples(self) -> Iterable[Tuple[str, LabelKey, float]]:
+        for key, value in self.values.items():
+            yield self.name, key, value
+
+
+class Gauge(Counter):
+    kind = "gauge"
+
+    def set(self, value: float, **labels: str) -> None:
+        self.values[label_key(labels)] = value
+
+
+class Histogram:
+    kind = "histogram"
+
+    def __init__(self, name: str, help_text: str, buckets: Iterable[float] = LATENCY_BUCKETS):
+        self.name = name
+        self.help_text = help_text
+        self.buckets = tuple(sorted(buckets))
+        self.values: Dict[LabelKey, Tuple[List[int], List[float]]] = {}
+
+    def observe(self, value: float, **labels: str) -> None:
+        key = label_key(labels)
+        entry = self.values.get(key)
+        if entry is None:
+            # One slot per bucket plus +Inf, and [sum, count]
+            entry = self.values[key] = ([0] * (len(self.buckets) + 1), [0.0, 0])
+        counts, totals = entry
+        counts[bisect.bisect_left(self.buckets, value)] += 1
+        totals[0] += value
+        totals[1] += 1
+
+    def samples(self) -> Iterable[Tuple[str, LabelKey, float]]:
+        for key, (counts, (total, count)) in self.values.items():
+            cumulative = 0
+            for bound, bucket_count in zip(self.buckets + (float("inf"),), counts):
+                cumulative += bucket_count
+                yield f"{self.name}_bucket", key + (("le", format_value(bound)),), cumulative
+            yield f"{self.name}_sum", key, total
+            yield f"{self.name}_count", key, count
+
+
+class RateMeter:
+    """Events per second over a sliding window of whole seconds."""
+
+    def __init__(self, window: int = 10):
+        self.window = window
+        self._seconds: Deque[List[int]] = deque()
+
+    def mark(self) -> None:
+        now = int(time.monotonic())
+        if self._seconds and self._seconds[-1][0] == now:
+            self._seconds[-1][1] += 1
+        else:
+            self._seconds.append([now, 1])
+        self._trim(now)
+
+    def _trim(self, now: int) -> None:
+        while self._seconds and self._seconds[0][0] <= now - self.window:
+            self._seconds.popleft()
+
+    def rate(self) -> float:
+        self._trim(int(time.monotonic()))
+        return sum(count for _, count in self._seconds) / self.window
+
+
+class Metrics:
+    """Delivery metrics of the plugin, rendered in the Prometheus text exposition format.
+
+    Hot paths only bump counters and histograms; gauges that mirror queue,
+    rate limiter, cache and broadcast state are collected when scraped.
+    """
+
+    def __init__(self, announcement: 'Announcement'):
+        self.announcement = announcement
+        self.send_rate = RateMeter()
+        self.sends = Counter("announcement_sends_total", "Messages sent to the homeserver by kind")
+        self.send_errors = Counter("announcement_send_errors_total", "Sends that failed for reasons other than rate limiting")
+        self.rate_limited = Counter("announcement_rate_limited_total", "Sends answered with M_LIMIT_EXCEEDED")
+        self.recalled = Counter("announcement_recalled_total",
+                                "Queued messages dropped because their announcement was redacted")
+        self.deliveries = Counter("announcement_deliveries_total", "Finished announcement deliveries by result")
+        self.send_seconds = Histogram("announcement_send_seconds", "Latency of sends to the homeserver")
+        self.backoff_seconds = Histogram("announcement_backoff_seconds", "Backoff chosen after a rate limited send",
+                                         BACKOFF_BUCKETS)
+        self.room_lookup_seconds = Histogram("announcement_room_lookup_seconds",
+                                             "Time to resolve or create the receiver room of a recipient")
+        self.broadcast_seconds = Histogram("announcement_broadcast_seconds",
+                                           "Time from receiving an announcement until every recipient was handled",
+                                           BROADCAST_BUCKETS)
+
+    def sent(self, kind: str, duration: float) -> None:
+        self.sends.inc(kind=kind)
+        self.send_seconds.observe(duration, kind=kind)
+        self.send_rate.mark()
+
+    def collect_state(self) -> Iterable[Counter]:
+        announcement = self.announcement
+        queue_processor = announcement.queue_processor
+        queue_depth = Gauge("announcement_queue_depth", "Messages waiting to be sent by priority")
+        for priority, depth in queue_processor.queue_depth().items():
+            queue_depth.set(depth, priority=priority)
+        sends_per_second = Gauge("announcement_sends_per_second", "Sends per second over the last 10 seconds")
+        sends_per_second.set(self.send_rate.rate())
+
+        limiter = queue_processor.rate_limiter.state()
+        tokens = Gauge("announcement_rate_limiter_tokens", "Tokens left in the send bucket")
+        tokens.set(limiter["tokens"])
+        sender_tokens = Gauge("announcement_sender_tokens", "Tokens left in the send bucket of each sender account")
+        for sender in queue_processor.senders:
+            sender_tokens.set(sender.rate_limiter.state()["tokens"], sender=sender.user_id)
+        partitions = Gauge("announcement_send_partitions", "Destinations with queued or in-flight sends")
+        partitions.set(len(queue_processor.scheduler.partitions))
+        blocked = Gauge("announcement_partition_backoff_seconds",
+                        "Remaining backoff of destinations that were rate limited")
+        for partition in queue_processor.scheduler.blocked():
+            blocked.set(partition.backoff.blocked_for(), partition=partition.key)
+
+        cache = announcement.room_manager.state_cache.stats()
+        cache_lookups = Counter("announcement_state_cache_lookups_total", "Room state cache lookups by result")
+        cache_lookups.inc(cache["hits"], result="hit")
+        cache_lookups.inc(cache["misses"], result="miss")
+        cache_ratio = Gauge("announcement_state_cache_hit_ratio", "Share of room state lookups served from the cache")
+        cache_ratio.set(cache["hit_ratio"])
+        cache_size = Gauge("announcement_state_cache_rooms", "Rooms held in the room state cache")
+        cache_size.set(cache["size"])
+        receiver_rooms = Gauge("announcement_receiver_rooms", "Receiver rooms in the room index")
+        receiver_rooms.set(len(announcement.room_index))
+
+        broadcasts = Gauge("announcement_broadcast_recipients",
+                           "Recipients of broadcasts in progress by origin event and state")
+        for progress in queue_processor.receipts.broadcasts():
+            broadcasts.set(len(progress.pending), origin_event=progress.origin_evt_id, state="pending")
+            broadcasts.set(len(progress.delivered), origin_event=progress.origin_evt_id, state="delivered")
+            broadcasts.set(len(progress.failed), origin_event=progress.origin_evt_id, state="failed")
+        return (queue_depth, sends_per_second, tokens, sender_tokens, partitions, blocked, cache_lookups, cache_ratio, cache_size,
+                receiver_rooms, broadcasts)
+
+    def render(self) -> str:
+        metrics = [self.sends, self.send_errors, self.rate_limited, self.recalled, self.deliveries,
+                   self.send_seconds, self.backoff_seconds, self.room_lookup_seconds, self.broadcast_seconds]
+        metrics.extend(self.collect_state())
+        lines = []
+        for metric in metrics:
+            lines.append(f"# HELP {metric.name} {metric.help_text}")
+            lines.append(f"# TYPE {metric.name} {metric.kind}")
+            for name, key, value in metric.samples():
+                lines.append(f"{name}{format_labels(key)} {format_value(value)}")
+        return "\n".join(lines) + "\n"
@@ -0,0 +1,132 @@
+import json
+import time
+from typing import Any, Callable, Dict, List, Set, Tuple
+from typing import TYPE_CHECKING
+
+from announcement.buffered_writer import BufferedWriter
+
+if TYPE_CHECKING:
+    from announcement.bot import Announcement
+
+PENDING = "pending"
+DELIVERED = "delivered"
+FAILED = "failed"
+
+
+class Outbox(BufferedWriter):
+    """Persistent record of queued deliveries so a reload or crash can resume a broadcast.
+
+    Writes are buffered and flushed in batches: new deliveries are inserted and
+    finished ones marked delivered or failed in one transaction per flush.
+    """
+
+    def __init__(self, announcement: 'Announcement', flush_interval: float = 0.5, batch_size: int = 500,
+                 retention_days: int = 7):
+        super().__init__(announcement, flush_interval, batch_size)
+        self.retention_days = retention_days
+        self._inserts: List[Tuple[Any, ...]] = []
+        self._updates: List[Tuple[Any, ...]] = []
+
+    @staticmethod
+    def serialize_content(content: Any) -> str:
+        return json.dumps(content.serialize() if hasattr(content, "serialize") else content)
+
+    def add(self, message: Dict[str, Any], priority: int) -> None:
+        """Record a delivery that was just queued."""
+        self._inserts.append((
+            message["origin_evt_id"], message["user"], message["origin_room_id"], message["room_id"],
+            self.serialize_content(message["content"]), priority, int(time.time() * 1000),
+        ))
+        self._schedule_flush()
+
+    def mark_delivered(self, message: Dict[str, Any], event_id: str) -> None:
+        self._updates.append((DELIVERED, event_id, message["origin_evt_id"], message["user"]))
+        self._schedule_flush()
+
+    def mark_failed(self, message: Dict[str, Any]) -> None:
+        self._updates.append((FAILED, None, message["origin_evt_id"], message["user"]))
+        self._schedule_flush()
+
+    async def remove(self, origin_evt_id: str) -> None:
+        """Forget every delivery of a recalled broadcast, including writes still buffered."""
+        async with self._flush_lock:
+            self._inserts = [row for row in self._inserts if row[0] != origin_evt_id]
+            self._updates = [row for row in self._updates if row[2] != origin_evt_id]
+            await self.database.execute("DELETE FROM outbox WHERE origin_evt_id=$1", origin_evt_id)
+
+    async def edit(self, origin_evt_id: str, edit: Callable[[Dict[str, Any]], Dict[str, Any]]) -> None:
+        """Rewrite the content of the pending deliveries of a broadcast, including buffered ones."""
+        edited: Dict[str, str] = {}
+
+        def rewrite(content: str) -> str:
+            # Every copy of a broadcast has the same content, so each distinct one is rewritten once
+            if content not in edited:
+                edited[content] = json.dumps(edit(json.loads(content)))
+            return edited[content]
+
+        async with self._flush_lock:
+            self._inserts = [row[:4] + (rewrite(row[4]),) + row[5:] if row[0] == origin_evt_id else row
+                             for row in self._inserts]
+            row = await self.database.fetchrow(
+                "SELECT content FROM outbox WHERE origin_evt_id=$1 AND status=$2 LIMIT 1", origin_evt_id, PENDING
+            )
+            if row:
+                await self.database.execute(
+                    "UPDATE outbox SET content=$1 WHERE origin_evt_id=$2 AND status=$3",
+                    rewrite(row["content"]), origin_evt_id, PENDING,
+                )
+
+    async def recipients(self, origin_evt_id: str) -> Set[str]:
+        """Return the users a broadcast was already queued for."""
+        await self.flush()
+        rows = await self.database.fetch("SELECT user_id FROM outbox WHERE origin_evt_id=$1", origin_evt_id)
+        return {row["user_id"] for row in rows}
+
+    async def load_pending(self) -> List[Tuple[Dict[str, Any], int]]:
+        """Load undelivered messages in their original order, pruning old finished rows first."""
+        cutoff = int((time.time() - self.retention_days * 24 * 60 * 60) * 1000)
+        await self.database.execute("DELETE FROM outbox WHERE status<>$1 AND created_at<$2", PENDING, cutoff)
+        rows = await self.database.fetch(
+            "SELECT origin_evt_id, user_id, origin_room_id, room_id, content, priority FROM outbox "
+            "WHERE status=$1 ORDER BY created_at",
+            PENDING,
+        )
+        return [
+            ({
+                "origin_room_id": row["origin_room_id"],
+                "origin_evt_id": row["origin_evt_id"],
+                "room_id": row["room_id"],
+                "content": json.loads(row["content"]),
+                "user": row["user_id"],
+            }, row["priority"])
+            for row in rows
+        ]
+
+    def _buffered(self) -> int:
+        return len(self._inserts) + len(self._updates)
+
+    async def _write(self) -> None:
+        """Write all buffered inserts and status updates."""
+        inserts, self._inserts = self._inserts, []
+        updates, self._updates = self._updates, []
+        if not inserts and not updates:
+            return
+        try:
+            async with self.database.acquire() as conn, conn.transaction():
+                if inserts:
+                    await conn.executemany(
+                        "INSERT INTO outbox (origin_evt_id, user_id, origin_room_id, room_id, content, "
+                        "priority, created_at) VALUES ($1, $2, $3, $4, $5, $6, $7) "
+                        "ON CONFLICT (origin_evt_id, user_id) DO NOTHING",
+                        inserts,
+                    )
+                if updates:
+                    await conn.executemany(
+                        "UPDATE outbox SET status=$1, event_id=$2 WHERE origin_evt_id=$3 AND user_id=$4",
+                        updates,
+                    )
+        except Exception as e:
+            self.log.error(f"Failed to write outbox: {e}")
+            # Keep the writes for the next flush
+            self._inserts = inserts + self._inserts
+            self._updates = updates + self._updates
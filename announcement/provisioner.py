@@ -0,0 +1,76 @@
+import asyncio
+from mautrix.types import RoomID
+from typing import Dict, FrozenSet, Iterable, Optional, Set, Tuple
+from typing import TYPE_CHECKING
+
+from announcement.rate_limiter import RateLimiter
+
+if TYPE_CHECKING:
+    from announcement.bot import Announcement
+
+
+class RoomProvisioner:
+    """Creates receiver rooms in the background as soon as users are added to an announcement room's Live list.
+
+    Room creation is paced by its own token bucket (`preprovision.per_second`)
+    so it never competes with deliveries for the send budget. Created rooms
+    are recorded in the receiver room index by RoomManager.
+    """
+
+    def __init__(self, announcement: 'Announcement'):
+        self.announcement = announcement
+        self.log = announcement.log
+        config = announcement.config.get("preprovision", {}) or {}
+        self.enabled = config.get("enabled", False)
+        self.rate_limiter = RateLimiter(rate=config.get("per_second", 0.5), burst=1)
+        self.queue: "asyncio.Queue[Tuple[RoomID, str]]" = asyncio.Queue()
+        # Last seen Live entries per (announcement room, shard state key)
+        self._known_live: Dict[Tuple[RoomID, str], FrozenSet[str]] = {}
+        self._queued: Set[Tuple[RoomID, str]] = set()
+        self._task: Optional[asyncio.Task] = None
+
+    def start(self) -> None:
+        if self.enabled and self._task is None:
+            self._task = asyncio.create_task(self.process_queue())
+
+    def stop(self) -> None:
+        if self._task:
+            self._task.cancel()
+            self._task = None
+
+    def live_changed(self, room_id: RoomID, state_key: str, live_entries: Iterable[str]) -> None:
+        """Diff a new Live shard against the last one seen and queue rooms for the added users."""
+        if not self.enabled:
+            return
+        new_live = frozenset(self.announcement.room_manager.groups.expand(live_entries))
+        added = new_live - self._known_live.get((room_id, state_key), frozenset())
+        self._known_live[(room_id, state_key)] = new_live
+        room_index = self.announcement.room_index
+        for user in added:
+            key = (room_id, user)
+            if key in self._queued or room_index.get(room_id, user):
+                continue
+            self._queued.add(key)
+            self.queue.put_nowait(key)
+        if added:
+            self.log.debug(f"{len(added)} users added to Live in {room_id}, {self.queue.qsize()} rooms to provision")
+
+    async def process_queue(self) -> None:
+        room_manager = self.announcement.room_manager
+        while True:
+            room_id, user = await self.queue.get()
+            try:
+                if await room_manager.get_existing_private_room(room_id, user):
+                    continue
+                room_state = await room_manager.fetch_room_state(room_id)
+                # Skip users removed from Live again while they were waiting
+                if user not in room_state.live:
+                    continue
+                await self.rate_limiter.acquire()
+                # Rate limited creations are retried by RoomManager
+                await room_manager.create_or_join_private_room(user, room_id, room_state)
+            except Exception as e:
+                self.log.error(f"Failed to provision room for {user} in {room_id}: {e}")
+            finally:
+                self._queued.discard((room_id, user))
+                self.queue.task_done()
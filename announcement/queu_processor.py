@@ -1,71 +1,448 @@
 import asyncio
-from collections import deque
+import hashlib
+import heapq
+import itertools
+import logging
+import time
+from collections import OrderedDict
+from mautrix.types import EventType
+from typing import Any, Dict, List, Optional, Set, Tuple
 from typing import TYPE_CHECKING
 
+from announcement.delivery_windows import DeliveryWindows
+from announcement.forwarded_events import ForwardedEvents
+from announcement.outbox import Outbox
+from announcement.receipts import DeliveryReceipts
+from announcement.rate_limiter import RateLimiter, get_retry_after_ms, is_rate_limited
+from announcement.send_scheduler import QueueEntry, SendScheduler
+from announcement.sender_pool import Sender, SenderPool
+
 if TYPE_CHECKING:
     from announcement.bot import Announcement
 
+# Lower values are delivered first
+HIGH_PRIORITY = 0
+NORMAL_PRIORITY = 1
+EDIT_PRIORITY = 2
+BULK_PRIORITY = 3
+
+PRIORITY_NAMES = {HIGH_PRIORITY: "high", NORMAL_PRIORITY: "normal", EDIT_PRIORITY: "edit", BULK_PRIORITY: "bulk"}
+# Share of sends each class gets while several have messages waiting
+PRIORITY_WEIGHTS = {HIGH_PRIORITY: 16, NORMAL_PRIORITY: 4, EDIT_PRIORITY: 2, BULK_PRIORITY: 1}
+
+# Content fields an admin can set on an announcement
+PRIORITY_FIELD = "org.minbh.announcement.priority"
+DELIVER_AT_FIELD = "org.minbh.announcement.deliver_at"
+BROADCAST_PRIORITIES = {"urgent": HIGH_PRIORITY, "normal": NORMAL_PRIORITY, "bulk": BULK_PRIORITY}
+
+# Number of redacted broadcasts remembered to drop copies that are still being fanned out
+RECALLED_LIMIT = 1000
+# Number of edited broadcasts whose latest content is remembered for copies that haven't been sent yet
+EDITED_LIMIT = 1000
+
 
 class QueueProcessor:
+    """Sends queued messages through a worker pool.
+
+    Pending sends are partitioned by destination (the recipient's server, or
+    the receiver room with `send_partitioning: room`). The token bucket of
+    the sending account paces sends, and the scheduler only hands out
+    entries whose account has a token. M_LIMIT_EXCEEDED blocks that bucket,
+    as the homeserver limits the account as a whole, and also backs off the
+    partition that hit it, so a destination that keeps failing gets pushed
+    back further than the rest of a broadcast.
+
+    Broadcasts with a deliver_at time wait in a timer heap until they are
+    due, and bulk broadcasts are only sent inside the configured
+    `bulk_windows`. Copies still queued when a broadcast is edited are sent
+    with the edited content.
+
+    With extra `senders`, messages to a receiver room go out from the account
+    assigned to it. Server partitions are kept per account, so a 429 answered
+    to one account doesn't hold back the others.
+    """
+
     def __init__(self, announcement: 'Announcement'):
         self.announcement = announcement
         self.log = announcement.log
+        self.worker_count = max(1, announcement.config.get("send_workers", 4))
+        self.partition_by_room = announcement.config.get("send_partitioning", "server") == "room"
+        self._sequence = itertools.count()
+        self._depth: Dict[int, int] = dict.fromkeys(PRIORITY_NAMES, 0)
+        # origin event ID -> sequence -> queued entry, so a redaction can recall a broadcast in O(k)
+        self._by_origin: Dict[str, Dict[int, QueueEntry]] = {}
+        self._recalled: "OrderedDict[str, None]" = OrderedDict()
+        # origin event ID -> (edit event ID, edit content) of the latest edit of a broadcast
+        self._edits: "OrderedDict[str, Tuple[str, Dict[str, Any]]]" = OrderedDict()
+        rate_limit = announcement.config.get("rate_limit", {}) or {}
+        self.rate_limiter = RateLimiter(
+            rate=rate_limit.get("per_second", 0.9),
+            burst=rate_limit.get("burst", 1),
+            max_backoff=rate_limit.get("max_backoff", 60),
+        )
+        self.senders = SenderPool(announcement, self.rate_limiter)
+        self.scheduler = SendScheduler(lambda: RateLimiter(
+            rate=self.rate_limiter.rate,
+            max_backoff=self.rate_limiter.max_backoff,
+        ), PRIORITY_WEIGHTS)
+        # (due time, sequence, entry) of broadcasts scheduled for later
+        self._scheduled: List[Tuple[float, int, QueueEntry]] = []
+        self._scheduled_sequences: Set[int] = set()
+        self._scheduled_timer: Optional[asyncio.TimerHandle] = None
+        try:
+            self.bulk_windows = DeliveryWindows(announcement.config.get("bulk_windows", []))
+        except ValueError as e:
+            self.log.error(f"Ignoring bulk_windows: {e}")
+            self.bulk_windows = DeliveryWindows()
+        self._window_timer: Optional[asyncio.TimerHandle] = None
+        self._workers: List[asyncio.Task] = []
+        self.outbox = Outbox(announcement) if announcement.config.get("persistent_queue", True) else None
+        self.forwarded_events = ForwardedEvents(announcement)
+        self.receipts = DeliveryReceipts(announcement, self)
+
+    def __len__(self) -> int:
+        return len(self.scheduler) + len(self._scheduled_sequences)
+
+    def enqueue(self, message: Dict[str, Any], priority: int = NORMAL_PRIORITY) -> None:
+        """Queue a message for delivery, waking an idle worker immediately."""
+        if self.origin_of(message) in self._recalled:
+            return
+        if self.is_delivery(message):
+            if self.outbox:
+                edit = self._edits.get(message['origin_evt_id'])
+                if edit:
+                    message = {**message, "content": self.edited_content(message['content'], edit[1])}
+                self.outbox.add(message, priority)
+            self.receipts.queued(message)
+        self._put((priority, next(self._sequence), message))
+
+    def _put(self, entry: QueueEntry) -> None:
+        self._track(entry)
+        due = self.deliver_at(entry[2])
+        if due is not None and due > time.time():
+            heapq.heappush(self._scheduled, (due, entry[1], entry))
+            self._scheduled_sequences.add(entry[1])
+            if self._scheduled[0][1] == entry[1]:
+                self._arm_scheduled_timer()
+            return
+        self._schedule(entry)
+
+    def _schedule(self, entry: QueueEntry) -> None:
+        sender = self.sender_for(entry[2])
+        self.scheduler.put(self.partition_key(entry[2]), entry, sender.rate_limiter if sender else None)
+
+    def _arm_scheduled_timer(self) -> None:
+        if self._scheduled_timer:
+            self._scheduled_timer.cancel()
+            self._scheduled_timer = None
+        if self._scheduled:
+            delay = max(0.0, self._scheduled[0][0] - time.time())
+            self._scheduled_timer = asyncio.get_running_loop().call_later(delay, self._release_scheduled)
+
+    def _release_scheduled(self) -> None:
+        """Move scheduled broadcasts that are due into the send queue."""
+        self._scheduled_timer = None
+        now = time.time()
+        while self._scheduled and self._scheduled[0][0] <= now:
+            _, sequence, entry = heapq.heappop(self._scheduled)
+            # Recalled entries were already removed from the set
+            if sequence in self._scheduled_sequences:
+                self._scheduled_sequences.discard(sequence)
+                self._schedule(entry)
+        self._arm_scheduled_timer()
+
+    def _update_bulk_window(self) -> None:
+        """Pause or resume bulk sends at the edges of the bulk delivery windows."""
+        if self.bulk_windows.is_open():
+            self.scheduler.resume(BULK_PRIORITY)
+        else:
+            self.scheduler.pause(BULK_PRIORITY)
+        if self.bulk_windows:
+            self._window_timer = asyncio.get_running_loop().call_later(
+                self.bulk_windows.seconds_until_change(), self._update_bulk_window
+            )
+
+    def _track(self, entry: QueueEntry) -> None:
+        priority, sequence, message = entry
+        self._depth[priority] = self._depth.get(priority, 0) + 1
+        origin = self.origin_of(message)
+        if origin:
+            self._by_origin.setdefault(origin, {})[sequence] = entry
+
+    def _untrack(self, entry: QueueEntry) -> None:
+        priority, sequence, message = entry
+        self._depth[priority] -= 1
+        origin = self.origin_of(message)
+        queued = self._by_origin.get(origin)
+        if queued is not None:
+            queued.pop(sequence, None)
+            if not queued:
+                del self._by_origin[origin]
+
+    async def recall(self, origin_evt_id: str) -> int:
+        """Drop everything still queued for a broadcast and stop any further copies. Returns the number dropped."""
+        self._recalled[origin_evt_id] = None
+        while len(self._recalled) > RECALLED_LIMIT:
+            self._recalled.popitem(last=False)
+        queued = self._by_origin.pop(origin_evt_id, {})
+        for priority, _, _ in queued.values():
+            self._depth[priority] -= 1
+        scheduled = self._scheduled_sequences.intersection(queued)
+        self._scheduled_sequences -= scheduled
+        self.scheduler.cancel(sequence for sequence in queued if sequence not in scheduled)
+        self.receipts.cancel(origin_evt_id)
+        if self.outbox:
+            await self.outbox.remove(origin_evt_id)
+        if queued:
+            self.announcement.metrics.recalled.inc(len(queued))
+            self.log.debug(f"Recalled {len(queued)} queued messages of {origin_evt_id}")
+        return len(queued)
+
+    async def edit(self, origin_evt_id: str, edit_evt_id: str, content: Dict[str, Any]) -> None:
+        """Send the copies of a broadcast that are still queued with the content of an edit."""
+        self._edits[origin_evt_id] = (edit_evt_id, content)
+        self._edits.move_to_end(origin_evt_id)
+        while len(self._edits) > EDITED_LIMIT:
+            self._edits.popitem(last=False)
+        if self.outbox:
+            await self.outbox.edit(origin_evt_id, lambda original: self.edited_content(original, content))
+
+    def enqueue_edit(self, origin_room_id: str, edit_evt_id: str, origin_evt_id: str, room_id: str, event_id: str,
+                     sender: Optional[str], content: Dict[str, Any]) -> None:
+        """Queue the replacement of one forwarded copy of an edited broadcast."""
+        self.enqueue({
+            "origin_room_id": origin_room_id,
+            "origin_evt_id": edit_evt_id,
+            "room_id": room_id,
+            "content": {
+                **content,
+                "m.relates_to": {"rel_type": "m.replace", "event_id": event_id},
+            },
+            "edit": True,
+            "edit_of": origin_evt_id,
+            # The replacement must come from the account that sent the copy
+            "sender": sender
+        }, EDIT_PRIORITY)
 
-    async def process_queue(self):
-        normal_sleep_time = self.announcement.sleep_time 
+    def partition_key(self, message: Dict[str, Any]) -> str:
+        """Return the destination a message is scheduled under."""
+        room_id = message['room_id']
+        if self.partition_by_room:
+            return room_id
+        user = message.get('user')
+        if user is None:
+            # Edits and state updates carry no user, but their receiver room maps to one
+            key = self.announcement.room_index.get_key(room_id)
+            user = key[1] if key else None
+        destination = (user or room_id).split(":", 1)[-1]
+        sender = self.sender_for(message)
+        return destination if sender is None or sender.is_main else f"{sender.user_id}|{destination}"
+
+    def sender_for(self, message: Dict[str, Any]) -> Optional[Sender]:
+        """Return the account to send a message from, or None if that account is no longer available.
+
+        Edits carry the account that sent the copy they replace, since clients
+        ignore replacements from anyone else. Everything else goes out from
+        the account assigned to the room.
+        """
+        if 'sender' in message:
+            return self.senders.get(message['sender'])
+        return self.senders.for_room(message['room_id'])
+
+    def queue_depth(self) -> Dict[str, int]:
+        """Return the number of queued messages per priority class."""
+        return {PRIORITY_NAMES.get(priority, str(priority)): depth for priority, depth in self._depth.items()}
+
+    def enqueue_receipt(self, message: Dict[str, Any]) -> None:
+        self.enqueue(message, HIGH_PRIORITY)
+
+    def enqueue_redaction(self, origin_evt_id: str, room_id: str, event_id: str) -> None:
+        """Queue the redaction of a forwarded copy; its record is dropped once the redaction went through."""
+        self.enqueue({"room_id": room_id, "redacts": event_id, "redaction_of": origin_evt_id}, HIGH_PRIORITY)
+
+    async def restore(self) -> None:
+        """Re-queue deliveries left pending in the outbox by a previous run."""
+        await self.forwarded_events.prune()
+        if not self.outbox:
+            return
+        pending = await self.outbox.load_pending()
+        for message, priority in pending:
+            self.receipts.queued(message)
+            self._put((priority, next(self._sequence), message))
+        if pending:
+            self.log.info(f"Resuming {len(pending)} pending deliveries from the outbox")
+
+    def start(self) -> None:
+        """Start the worker pool, with send_workers workers per sender account."""
+        if self._workers:
+            return
+        self._workers = [
+            asyncio.create_task(self.process_queue(n)) for n in range(self.worker_count * len(self.senders))
+        ]
+        self._update_bulk_window()
+
+    async def stop(self) -> None:
+        """Stop all workers. Messages still queued are dropped unless the outbox is enabled."""
+        for timer in (self._scheduled_timer, self._window_timer):
+            if timer:
+                timer.cancel()
+        self.scheduler.close()
+        self.receipts.close()
+        for worker in self._workers:
+            worker.cancel()
+        await asyncio.gather(*self._workers, return_exceptions=True)
+        self._workers = []
+        if self.outbox:
+            await self.outbox.close()
+        await self.forwarded_events.close()
+
+    async def process_queue(self, worker_id: int = 0):
         while True:
+            partition, entry = await self.scheduler.get()
+            priority, _, message = entry
+            self._untrack(entry)
+            metrics = self.announcement.metrics
+            kind = self.message_kind(message)
+            sender = self.sender_for(message)
+            if sender is None:
+                self.log.warning(f"Dropping edit in {message['room_id']}: {message['sender']} is no longer a sender")
+                self.scheduler.done(partition)
+                continue
             try:
-                # Check for high-priority messages first
-                if self.announcement.high_priority_queue:
-                    async with self.announcement.lock:
-                        message = self.announcement.high_priority_queue.popleft()  # Get high-priority message
-                elif self.announcement.message_queue:
-                    async with self.announcement.lock:
-                        message = self.announcement.message_queue.popleft()  # Get regular message
-                else:
-                    await asyncio.sleep(normal_sleep_time)  # Sleep briefly if both queues are empty
-                    self.log.debug(f"Waiting..................")
-                    continue  # Go back to the start of the loop
-
-                # Send the message
-                try:
-                    if message.get('read_receipt'):
-                        await self.announcement.client.send_message(message['room_id'], message['content'])
-                    else: 
-                        self.log.debug(f"Will send message ..................{message['room_id']}, {message['content']}")
-                        event_id = await self.announcement.client.send_message(message['room_id'], message['content'])
-                        if event_id:
-                            message_content = {
-                                "msgtype": "m.text",
-                                "body": f"🔔 *Sent for*:{message['user']}",
-                                "format": "org.matrix.custom.html",
-                                "formatted_body": f"🔔 <em>Sent for</em>: {message['user']}",
-                                "m.relates_to": {
-                                    'rel_type': 'm.thread',
-                                    'event_id': message['origin_evt_id']
-                                }
-                            }
-                            message_read = {
-                                "room_id": message['origin_room_id'],
-                                "content": message_content,
-                                "read_receipt": True
-                            }
-
-                            async with self.announcement.lock:
-                                self.announcement.high_priority_queue.append(message_read)  # Always add high-priority messages
-                    self.announcement.sleep_time = normal_sleep_time
-                except Exception as e:
-                    error_message = str(e)
-                    if "Too Many Requests" in error_message:
-                        self.announcement.sleep_time *= 2 
-                        self.log.warning(f"Rate limit hit! Increasing sleep time {self.announcement.sleep_time}.")
-                        if message.get('read_receipt'):
-                            self.announcement.high_priority_queue.appendleft(message)
-                        else:
-                            self.announcement.message_queue.appendleft(message)
-                        continue
-                    else:
-                        self.log.error(f"Error sending message: {e}")
+                if sender.rate_limiter is not partition.account:
+                    # The room moved to another account after the message was queued
+                    await sender.rate_limiter.acquire()
+                started = time.perf_counter()
+                await self.send(message, sender)
+                metrics.sent(kind, time.perf_counter() - started)
+                sender.rate_limiter.on_success()
+                partition.backoff.on_success()
             except Exception as e:
-                self.log.error(f"Error processing message: {e}")
-                await asyncio.sleep(self.announcement.sleep_time)  # Optional: wait briefly before trying again
\ No newline at end of file
+                if is_rate_limited(e):
+                    if message.get('receipt_for'):
+                        self.receipts.requeued(message)
+                    retry_after_ms = get_retry_after_ms(e)
+                    # The homeserver limits the sending account, so every partition it sends to has to slow down
+                    account_backoff = sender.rate_limiter.on_rate_limited(retry_after_ms)
+                    # Re-queue with the original sequence number so it keeps its place at the head of its partition
+                    self._track(entry)
+                    backoff = max(account_backoff, self.scheduler.retry(partition, entry, retry_after_ms))
+                    metrics.rate_limited.inc(kind=kind)
+                    metrics.backoff_seconds.observe(backoff)
+                    self.log.debug(f"Rate limit hit sending to {partition.key} as {sender.user_id}! "
+                                   f"Backing off for {backoff:.1f}s.")
+                else:
+                    metrics.send_errors.inc(kind=kind)
+                    self.log.error(f"Error sending message: {e}")
+                    if message.get('receipt_for'):
+                        self.receipts.sent(message, None)
+                    elif self.is_delivery(message):
+                        if self.outbox:
+                            self.outbox.mark_failed(message)
+                        self.receipts.failed(message)
+            finally:
+                self.scheduler.done(partition)
+
+    async def send(self, message: Dict[str, Any], sender: Optional[Sender] = None) -> None:
+        """Send one queued message and record its delivery."""
+        sender = sender or self.senders.main
+        client = sender.client
+        if message.get('receipt_for'):
+            content = self.receipts.render(message)
+            if content is not None:
+                event_id = await client.send_message(message['room_id'], content)
+                self.receipts.sent(message, event_id)
+            return
+        if message.get('state_event'):
+            event_type = EventType.find(message['state_event'], EventType.Class.STATE)
+            await client.send_state_event(message['room_id'], event_type, message['content'])
+            self.announcement.state_propagator.sent(message['room_id'], message['state_event'], message['content'])
+            return
+        if message.get('redacts'):
+            await client.redact(message['room_id'], message['redacts'])
+            self.forwarded_events.remove_copy(message['redaction_of'], message['room_id'])
+            return
+        if not self.is_delivery(message):
+            await client.send_message(message['room_id'], message['content'])
+            return
+
+        if self.log.isEnabledFor(logging.DEBUG):
+            self.log.debug(f"Will send message ..................{message['room_id']}, {message['content']}")
+        edit = self._edits.get(message['origin_evt_id'])
+        content = self.edited_content(message['content'], edit[1]) if edit else message['content']
+        # A stable transaction ID lets the homeserver drop a resend after a crash between send and bookkeeping
+        event_id = await client.send_message_event(
+            message['room_id'], EventType.ROOM_MESSAGE, content, txn_id=self.delivery_txn_id(message)
+        )
+        if message['origin_evt_id'] in self._recalled:
+            # Redacted while this copy was in flight
+            if event_id:
+                await client.redact(message['room_id'], event_id)
+            return
+        if self.outbox:
+            self.outbox.mark_delivered(message, event_id)
+        sender_id = None if sender.is_main else sender.user_id
+        if event_id:
+            self.forwarded_events.add(message['origin_evt_id'], message['room_id'], event_id, message['user'],
+                                      sender_id)
+            latest = self._edits.get(message['origin_evt_id'])
+            if latest is not None and latest is not edit:
+                # Edited while this copy was in flight, after the edit looked up the copies to replace
+                self.enqueue_edit(message['origin_room_id'], latest[0], message['origin_evt_id'],
+                                  message['room_id'], event_id, sender_id, latest[1])
+        self.receipts.delivered(message)
+
+    @staticmethod
+    def is_delivery(message: Dict[str, Any]) -> bool:
+        """Check whether a queued message is an announcement copy rather than a receipt, edit or state update."""
+        return (not message.get('read_receipt') and not message.get('edit') and not message.get('state_event')
+                and not message.get('redacts'))
+
+    @staticmethod
+    def broadcast_priority(content: Any) -> int:
+        """Return the queue priority an announcement asked for with org.minbh.announcement.priority."""
+        return BROADCAST_PRIORITIES.get(str(content.get(PRIORITY_FIELD, "normal")).lower(), NORMAL_PRIORITY)
+
+    @staticmethod
+    def deliver_at(message: Dict[str, Any]) -> Optional[float]:
+        """Return when a delivery should go out as a UNIX timestamp, if its announcement was scheduled."""
+        if not QueueProcessor.is_delivery(message):
+            return None
+        value = message['content'].get(DELIVER_AT_FIELD)
+        try:
+            # Milliseconds, like origin_server_ts
+            return float(value) / 1000 if value is not None else None
+        except (TypeError, ValueError):
+            return None
+
+    @staticmethod
+    def edited_content(content: Any, edit: Dict[str, Any]) -> Dict[str, Any]:
+        """Return the content of a copy sent after an edit, keeping the delivery options of the original."""
+        edited = dict(edit["m.new_content"])
+        for field in (PRIORITY_FIELD, DELIVER_AT_FIELD):
+            value = content.get(field)
+            if value is not None:
+                edited.setdefault(field, value)
+        return edited
+
+    @staticmethod
+    def origin_of(message: Dict[str, Any]) -> Optional[str]:
+        """Return the announcement a queued message belongs to, if any."""
+        return message.get('receipt_for') or message.get('edit_of') or message.get('origin_evt_id')
+
+    @staticmethod
+    def message_kind(message: Dict[str, Any]) -> str:
+        if message.get('receipt_for'):
+            return "receipt"
+        if message.get('state_event'):
+            return "state"
+        if message.get('edit'):
+            return "edit"
+        if message.get('redacts'):
+            return "redaction"
+        return "delivery" if QueueProcessor.is_delivery(message) else "other"
+
+    @staticmethod
+    def delivery_txn_id(message: Dict[str, Any]) -> str:
+        key = f"{message['origin_evt_id']}|{message['user']}".encode("utf-8")
+        return f"org.minbh.announcement.{hashlib.sha256(key).hexdigest()[:32]}"
@@ -0,0 +1,154 @@
+import asyncio
+import json
+import random
+import time
+from mautrix.api import HTTPAPI
+from mautrix.errors import MatrixRequestError, MLimitExceeded, make_request_error
+from typing import Any, Dict, Optional
+
+
+def is_rate_limited(error: Exception) -> bool:
+    """Check whether a request failed because the homeserver rate limited it."""
+    return isinstance(error, MLimitExceeded) or getattr(error, "http_status", None) == 429
+
+
+def get_retry_after_ms(error: Exception) -> Optional[int]:
+    """Extract retry_after_ms from a rate limit error, if the homeserver sent one."""
+    retry_after = getattr(error, "retry_after_ms", None)
+    if retry_after is None:
+        try:
+            retry_after = json.loads(getattr(error, "text", "") or "{}").get("retry_after_ms")
+        except (ValueError, AttributeError):
+            return None
+    try:
+        return int(retry_after) if retry_after is not None else None
+    except (TypeError, ValueError):
+        return None
+
+
+def request_error(http_status: int, text: str, retry_after: Optional[str] = None) -> MatrixRequestError:
+    """Build the error mautrix raises for a failed response, keeping retry_after_ms.
+
+    The hint is taken from the response body, or from the Retry-After header
+    (in seconds) if the body has none.
+    """
+    try:
+        data = json.loads(text)
+    except ValueError:
+        data = None
+    if not isinstance(data, dict):
+        data = {}
+    error = make_request_error(
+        http_status=http_status,
+        text=text,
+        errcode=data.get("errcode"),
+        message=data.get("error"),
+        unstable_errcode=data.get("org.matrix.msc3848.unstable.errcode"),
+    )
+    retry_after_ms = data.get("retry_after_ms")
+    if retry_after_ms is None and retry_after and retry_after.strip().isdigit():
+        retry_after_ms = int(retry_after) * 1000
+    if retry_after_ms is not None:
+        error.retry_after_ms = retry_after_ms
+    return error
+
+
+def keep_retry_after(api: HTTPAPI) -> None:
+    """Make a client's HTTPAPI raise errors that carry retry_after_ms.
+
+    mautrix builds MLimitExceeded from the errcode and message alone and drops
+    the rest of the response, so its _send is replaced by one that builds the
+    error with request_error().
+    """
+    if getattr(api, "_keeps_retry_after", False):
+        return
+
+    async def send(method, url, content, query_params, headers):
+        request = api.session.request(str(method), url, data=content, params=query_params, headers=headers)
+        async with request as response:
+            if response.status < 200 or response.status >= 300:
+                raise request_error(response.status, await response.text(), response.headers.get("Retry-After"))
+            return await response.json(), response
+
+    api._send = send
+    api._keeps_retry_after = True
+
+
+class RateLimiter:
+    """Token bucket pacing outgoing requests, backing off when the homeserver returns M_LIMIT_EXCEEDED."""
+
+    def __init__(self, rate: float, burst: int = 1, max_backoff: float = 60.0, min_backoff: float = 1.0):
+        self.rate = rate
+        self.burst = max(1, burst)
+        self.max_backoff = max_backoff
+        self.min_backoff = min_backoff
+        self.tokens = float(self.burst)
+        self.rate_limit_hits = 0
+        self.consecutive_rate_limits = 0
+        self.last_backoff = 0.0
+        self._updated = time.monotonic()
+        self._blocked_until = 0.0
+
+    def _refill(self, now: float) -> None:
+        self.tokens = min(self.burst, self.tokens + (now - self._updated) * self.rate)
+        self._updated = now
+
+    def reserve(self) -> float:
+        """Take a token and return how many seconds the caller must wait before using it."""
+        now = time.monotonic()
+        self._refill(now)
+        # The balance may go negative: later callers queue up behind earlier reservations
+        self.tokens -= 1
+        wait = -self.tokens / self.rate if self.tokens < 0 else 0.0
+        return max(wait, self._blocked_until - now)
+
+    def available_in(self) -> float:
+        """Return how many seconds until reserve() would not have to wait, without taking a token."""
+        now = time.monotonic()
+        self._refill(now)
+        # Tolerance for the refill arithmetic, so a caller woken on time isn't sent back for a few nanoseconds
+        wait = (1 - self.tokens) / self.rate if self.tokens < 1 - 1e-9 else 0.0
+        return max(wait, self._blocked_until - now, 0.0)
+
+    async def acquire(self) -> None:
+        """Wait until a request may be sent."""
+        wait = self.reserve()
+        while wait > 0:
+            await asyncio.sleep(wait)
+            # A 429 may have blocked the bucket while this reservation was waiting
+            wait = self._blocked_until - time.monotonic()
+
+    def blocked_for(self) -> float:
+        """Return how many seconds are left of the current backoff."""
+        return max(0.0, self._blocked_until - time.monotonic())
+
+    def on_success(self) -> None:
+        self.consecutive_rate_limits = 0
+
+    def on_rate_limited(self, retry_after_ms: Optional[int] = None) -> float:
+        """Block the bucket after a 429 and return the chosen backoff in seconds."""
+        self.rate_limit_hits += 1
+        self.consecutive_rate_limits += 1
+        exponential = self.min_backoff * 2 ** (self.consecutive_rate_limits - 1)
+        backoff = max(exponential, (retry_after_ms or 0) / 1000)
+        backoff = min(self.max_backoff, backoff * random.uniform(1.0, 1.2))
+        now = time.monotonic()
+        self._blocked_until = max(self._blocked_until, now + backoff)
+        self._refill(now)
+        self.tokens = min(self.tokens, 0.0)
+        self.last_backoff = backoff
+        return backoff
+
+    def state(self) -> Dict[str, Any]:
+        now = time.monotonic()
+        self._refill(now)
+        return {
+            "rate": self.rate,
+            "burst": self.burst,
+            "tokens": self.tokens,
+            "blocked_for": max(0.0, self._blocked_until - now),
+            "last_backoff": self.last_backoff,
+            "rate_limit_hits": self.rate_limit_hits,
+            "consecutive_rate_limits": self.consecutive_rate_limits,
+        }
+
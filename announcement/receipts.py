@@ -0,0 +1,195 @@
+import asyncio
+import time
+from typing import Any, Dict, Iterable, List, Optional, Set
+from typing import TYPE_CHECKING
+
+if TYPE_CHECKING:
+    from announcement.bot import Announcement
+    from announcement.queu_processor import QueueProcessor
+
+
+class BroadcastProgress:
+    __slots__ = ("origin_room_id", "origin_evt_id", "pending", "delivered", "failed", "receipt_event_id",
+                 "receipt_queued", "receipt_sending", "unreported", "flush_handle", "started")
+
+    def __init__(self, origin_room_id: str, origin_evt_id: str):
+        self.origin_room_id = origin_room_id
+        self.origin_evt_id = origin_evt_id
+        self.pending: Set[str] = set()
+        self.delivered: List[str] = []
+        self.failed: List[str] = []
+        self.receipt_event_id: Optional[str] = None
+        self.receipt_queued = False
+        self.receipt_sending = False
+        self.unreported = 0
+        self.flush_handle: Optional[asyncio.TimerHandle] = None
+        self.started = time.monotonic()
+
+
+class DeliveryReceipts:
+    """Aggregates per-recipient delivery results into one "Sent for" thread message per broadcast.
+
+    Receipts are flushed after a time window or once enough deliveries have
+    finished, and rendered when they are actually sent so a queued receipt
+    always carries the latest counts. With edit_in_place the thread message
+    is updated with m.replace instead of posting a new one.
+    """
+
+    def __init__(self, announcement: 'Announcement', queue_processor: 'QueueProcessor'):
+        self.announcement = announcement
+        self.queue_processor = queue_processor
+        self.log = announcement.log
+        config = announcement.config.get("receipts", {}) or {}
+        self.window = config.get("window", 5)
+        self.batch = max(1, config.get("batch", 100))
+        self.edit_in_place = config.get("edit_in_place", True)
+        self.max_listed = config.get("max_listed", 50)
+        self._broadcasts: Dict[str, BroadcastProgress] = {}
+
+    def __len__(self) -> int:
+        return len(self._broadcasts)
+
+    def get(self, origin_evt_id: str) -> Optional[BroadcastProgress]:
+        return self._broadcasts.get(origin_evt_id)
+
+    def broadcasts(self) -> Iterable[BroadcastProgress]:
+        return self._broadcasts.values()
+
+    def expect(self, origin_room_id: str, origin_evt_id: str, users: Iterable[str]) -> None:
+        """Register every recipient of a broadcast up front, before their rooms are resolved."""
+        users = list(users)
+        progress = self._broadcasts.get(origin_evt_id)
+        if progress is None:
+            if not users:
+                # Nothing would ever finish the broadcast and release it
+                return
+            progress = self._broadcasts[origin_evt_id] = BroadcastProgress(origin_room_id, origin_evt_id)
+        progress.pending.update(users)
+
+    def cancel(self, origin_evt_id: str) -> Optional[BroadcastProgress]:
+        """Stop tracking a recalled broadcast. Its queued receipt is dropped by the queue processor."""
+        progress = self._broadcasts.pop(origin_evt_id, None)
+        if progress is not None and progress.flush_handle is not None:
+            progress.flush_handle.cancel()
+        return progress
+
+    def close(self) -> None:
+        """Cancel the pending receipt flushes."""
+        for progress in self._broadcasts.values():
+            if progress.flush_handle is not None:
+                progress.flush_handle.cancel()
+                progress.flush_handle = None
+
+    def queued(self, message: Dict[str, Any]) -> None:
+        self.expect(message['origin_room_id'], message['origin_evt_id'], (message['user'],))
+
+    def delivered(self, message: Dict[str, Any]) -> None:
+        self._finish(message, delivered=True)
+
+    def failed(self, message: Dict[str, Any]) -> None:
+        self._finish(message, delivered=False)
+
+    def _finish(self, message: Dict[str, Any], delivered: bool) -> None:
+        progress = self._broadcasts.get(message['origin_evt_id'])
+        if progress is None or message['user'] not in progress.pending:
+            return
+        progress.pending.discard(message['user'])
+        (progress.delivered if delivered else progress.failed).append(message['user'])
+        progress.unreported += 1
+        metrics = self.announcement.metrics
+        metrics.deliveries.inc(result="delivered" if delivered else "failed")
+        if not progress.pending:
+            metrics.broadcast_seconds.observe(time.monotonic() - progress.started)
+        if progress.unreported >= self.batch or not progress.pending:
+            self.flush(progress.origin_evt_id)
+        else:
+            self._schedule_flush(progress)
+
+    def _schedule_flush(self, progress: BroadcastProgress) -> None:
+        if progress.flush_handle is None:
+            progress.flush_handle = asyncio.get_running_loop().call_later(
+                self.window, self.flush, progress.origin_evt_id
+            )
+
+    def flush(self, origin_evt_id: str) -> None:
+        """Queue a receipt for a broadcast unless one is already queued or being sent."""
+        progress = self._broadcasts.get(origin_evt_id)
+        if progress is None:
+            return
+        if progress.flush_handle is not None:
+            progress.flush_handle.cancel()
+            progress.flush_handle = None
+        if progress.receipt_queued or progress.receipt_sending or progress.unreported == 0:
+            return
+        progress.receipt_queued = True
+        self.queue_processor.enqueue_receipt({
+            "room_id": progress.origin_room_id,
+            "receipt_for": origin_evt_id,
+            "read_receipt": True
+        })
+
+    def render(self, message: Dict[str, Any]) -> Optional[Dict[str, Any]]:
+        """Build the receipt content for a queued receipt from the current progress."""
+        progress = self._broadcasts.get(message['receipt_for'])
+        if progress is None:
+            return None
+        progress.receipt_queued = False
+        progress.receipt_sending = True
+        progress.unreported = 0
+        total = len(progress.pending) + len(progress.delivered) + len(progress.failed)
+        lines = [f"Delivered {len(progress.delivered)}/{total}, pending {len(progress.pending)}, "
+                 f"failed {len(progress.failed)}"]
+        html_lines = [f"<em>Delivered</em> {len(progress.delivered)}/{total}, "
+                      f"<em>pending</em> {len(progress.pending)}, <em>failed</em> {len(progress.failed)}"]
+        for label, users in (("Sent for", progress.delivered), ("Pending", sorted(progress.pending)),
+                             ("Failed", progress.failed)):
+            if users:
+                listed = ", ".join(users[:self.max_listed])
+                if len(users) > self.max_listed:
+                    listed += f" and {len(users) - self.max_listed} more"
+                lines.append(f"{label}: {listed}")
+                html_lines.append(f"<em>{label}</em>: {listed}")
+        content = {
+            "msgtype": "m.text",
+            "body": "🔔 " + "\n".join(lines),
+            "format": "org.matrix.custom.html",
+            "formatted_body": "🔔 " + "<br/>".join(html_lines),
+        }
+        if progress.receipt_event_id and self.edit_in_place:
+            return {
+                "msgtype": "m.text",
+                "body": f"* {content['body']}",
+                "m.new_content": content,
+                "m.relates_to": {
+                    "rel_type": "m.replace",
+                    "event_id": progress.receipt_event_id
+                }
+            }
+        content["m.relates_to"] = {
+            "rel_type": "m.thread",
+            "event_id": progress.origin_evt_id
+        }
+        return content
+
+    def sent(self, message: Dict[str, Any], event_id: Optional[str]) -> None:
+        """Remember the receipt event and report anything that finished while it was being sent."""
+        progress = self._broadcasts.get(message['receipt_for'])
+        if progress is None:
+            return
+        progress.receipt_sending = False
+        if progress.receipt_event_id is None:
+            progress.receipt_event_id = event_id
+        if progress.unreported:
+            if progress.pending:
+                self._schedule_flush(progress)
+            else:
+                self.flush(progress.origin_evt_id)
+        elif not progress.pending:
+            del self._broadcasts[message['receipt_for']]
+
+    def requeued(self, message: Dict[str, Any]) -> None:
+        """Mark a receipt as queued again after its send was rate limited."""
+        progress = self._broadcasts.get(message['receipt_for'])
+        if progress is not None:
+            progress.receipt_sending = False
+            progress.receipt_queued = True
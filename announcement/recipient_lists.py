@@ -0,0 +1,94 @@
+import json
+import zlib
+from typing import Any, Dict, Iterable, List, Mapping, Optional, Sequence, Tuple
+
+LIVE = "Live"
+GENERAL = "General"
+LISTS = (GENERAL, LIVE)
+
+# Entries starting with this sigil name a group from the `groups` config section instead of a user
+GROUP_SIGIL = "+"
+
+# Matrix caps events at 64 KiB including their envelope. Shard 0 of General and of Live share the "" event,
+# so each shard gets a bit over a third of that.
+MAX_SHARD_BYTES = 24 * 1024
+
+
+class RecipientGroups:
+    """Named user groups from the `groups` config section, referenced in recipient lists as "+name"."""
+
+    __slots__ = ("_groups",)
+
+    def __init__(self, groups_config: Optional[Mapping[str, Iterable[str]]] = None):
+        self._groups: Dict[str, Tuple[str, ...]] = {
+            name: tuple(users or ()) for name, users in (groups_config or {}).items()
+        }
+
+    def __len__(self) -> int:
+        return len(self._groups)
+
+    def expand(self, entries: Iterable[str]) -> Tuple[str, ...]:
+        """Replace group references with their members, dropping duplicates and keeping the first position."""
+        seen = set()
+        users = []
+        for entry in entries:
+            members = self._groups.get(entry[1:], ()) if entry.startswith(GROUP_SIGIL) else (entry,)
+            for user in members:
+                if user not in seen:
+                    seen.add(user)
+                    users.append(user)
+        return tuple(users)
+
+
+def shard_state_key(list_name: str, index: int) -> str:
+    """Return the state key of a recipient list shard. Shard 0 is stored inline in the "" event."""
+    return "" if index == 0 else f"{list_name}/{index}"
+
+
+def parse_shard_state_key(state_key: str) -> Optional[Tuple[str, int]]:
+    list_name, _, index = state_key.partition("/")
+    if list_name not in LISTS or not index.isdigit() or int(index) == 0:
+        return None
+    return list_name, int(index)
+
+
+def shard_entries(list_name: str, state_key: str, content: Dict[str, Any]) -> Optional[List[str]]:
+    """Return the entries an org.minbh.announcement event holds for a list, or None if it isn't one of its shards."""
+    if state_key == "":
+        return list(content.get(list_name, []))
+    parsed = parse_shard_state_key(state_key)
+    if parsed is None or parsed[0] != list_name:
+        return None
+    return list(content.get("users", []))
+
+
+def shard_index(entry: str, count: int) -> int:
+    # crc32 rather than hash() so every process places an entry in the same shard
+    return zlib.crc32(entry.encode("utf-8")) % count if count > 1 else 0
+
+
+def split(entries: Sequence[str], count: int) -> List[List[str]]:
+    shards: List[List[str]] = [[] for _ in range(count)]
+    for entry in entries:
+        shards[shard_index(entry, count)].append(entry)
+    return shards
+
+
+def serialized_size(entries: Sequence[str]) -> int:
+    """Return the size of a shard's entries as the homeserver measures them, in canonical JSON."""
+    return len(json.dumps(list(entries), ensure_ascii=False, separators=(",", ":")).encode("utf-8"))
+
+
+def plan_shards(entries: Sequence[str], existing_count: int, shard_size: int,
+                max_bytes: int = MAX_SHARD_BYTES) -> List[List[str]]:
+    """Split a list into hash-placed shards of at most shard_size entries and max_bytes of JSON.
+
+    The shard count only ever grows, so adding or removing an entry changes
+    exactly one shard unless the list outgrows its current shards.
+    """
+    count = max(1, existing_count, -(-len(entries) // shard_size), -(-serialized_size(entries) // max_bytes))
+    shards = split(entries, count)
+    while any(len(shard) > shard_size or serialized_size(shard) > max_bytes for shard in shards):
+        count *= 2
+        shards = split(entries, count)
+    return shards
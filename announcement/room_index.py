@@ -0,0 +1,96 @@
+import asyncio
+from mautrix.types import RoomID, UserID
+from typing import Dict, Optional, Tuple
+from typing import TYPE_CHECKING
+
+if TYPE_CHECKING:
+    from announcement.bot import Announcement
+
+
+class RoomIndex:
+    """In-memory (announcement room, user) -> receiver room index backed by the plugin database.
+
+    Rooms created for an extra sender account also remember that account; rooms
+    without one are sent to by the bot itself.
+    """
+
+    def __init__(self, announcement: 'Announcement'):
+        self.announcement = announcement
+        self.database = announcement.database
+        self.log = announcement.log
+        self._rooms: Dict[Tuple[RoomID, UserID], RoomID] = {}
+        self._keys: Dict[RoomID, Tuple[RoomID, UserID]] = {}
+        self._senders: Dict[RoomID, UserID] = {}
+        # Set once the index was loaded or built at start-up; lookups before that would miss rooms
+        self.ready = asyncio.Event()
+
+    def __len__(self) -> int:
+        return len(self._rooms)
+
+    async def load(self) -> None:
+        """Load the stored index into memory."""
+        rows = await self.database.fetch("SELECT room_id, announcement_room, user_id, sender FROM receiver_room")
+        self._rooms.clear()
+        self._keys.clear()
+        self._senders.clear()
+        for row in rows:
+            self._set(row["announcement_room"], row["user_id"], row["room_id"], row["sender"])
+        self.log.debug(f"Loaded {len(self._rooms)} receiver rooms from the database")
+
+    def get(self, announcement_room: RoomID, user_id: UserID) -> Optional[RoomID]:
+        """Return the receiver room of a user for an announcement room, if known."""
+        return self._rooms.get((announcement_room, user_id))
+
+    def get_key(self, room_id: RoomID) -> Optional[Tuple[RoomID, UserID]]:
+        """Return the (announcement room, user) pair a receiver room belongs to."""
+        return self._keys.get(room_id)
+
+    def get_sender(self, room_id: RoomID) -> Optional[UserID]:
+        """Return the extra sender account assigned to a receiver room, if any."""
+        return self._senders.get(room_id)
+
+    def is_receiver_room(self, room_id: RoomID) -> bool:
+        return room_id in self._keys
+
+    def room_ids(self):
+        return self._keys.keys()
+
+    async def add(self, announcement_room: RoomID, user_id: UserID, room_id: RoomID,
+                  sender: Optional[UserID] = None) -> None:
+        """Record a receiver room, replacing any previous room for the same pair."""
+        previous = self._rooms.get((announcement_room, user_id))
+        if previous == room_id and self._senders.get(room_id) == sender:
+            return
+        if previous:
+            self._keys.pop(previous, None)
+            self._senders.pop(previous, None)
+        self._set(announcement_room, user_id, room_id, sender)
+        async with self.database.acquire() as conn, conn.transaction():
+            await conn.execute(
+                "DELETE FROM receiver_room WHERE room_id=$1 OR (announcement_room=$2 AND user_id=$3)",
+                room_id, announcement_room, user_id,
+            )
+            await conn.execute(
+                "INSERT INTO receiver_room (room_id, announcement_room, user_id, sender) VALUES ($1, $2, $3, $4)",
+                room_id, announcement_room, user_id, sender,
+            )
+
+    async def clear_sender(self, room_id: RoomID) -> None:
+        """Fall back to the bot for a room whose sender account left."""
+        if self._senders.pop(room_id, None):
+            await self.database.execute("UPDATE receiver_room SET sender=NULL WHERE room_id=$1", room_id)
+
+    async def remove(self, room_id: RoomID) -> None:
+        """Forget a receiver room."""
+        key = self._keys.pop(room_id, None)
+        self._senders.pop(room_id, None)
+        if key and self._rooms.get(key) == room_id:
+            del self._rooms[key]
+        await self.database.execute("DELETE FROM receiver_room WHERE room_id=$1", room_id)
+
+    def _set(self, announcement_room: RoomID, user_id: UserID, room_id: RoomID,
+             sender: Optional[UserID] = None) -> None:
+        self._rooms[(announcement_room, user_id)] = room_id
+        self._keys[room_id] = (announcement_room, user_id)
+        if sender:
+            self._senders[room_id] = sender
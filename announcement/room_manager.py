@@ -1,13 +1,21 @@
 from mautrix.types import RoomID, Membership
 from mautrix.api import Method, Path
-from typing import Optional, List, Dict, Any
+from typing import Optional, Dict, Any, Awaitable, Callable, List, Tuple, TypeVar
 from typing import TYPE_CHECKING
-from mautrix.types import RoomDirectoryVisibility, RoomCreatePreset, RoomID, EventType
+from mautrix.types import RoomDirectoryVisibility, RoomCreatePreset, RoomID, EventType, StateEvent, RedactionEvent
+import asyncio
 import uuid
 from maubot import MessageEvent
+from announcement.state_cache import RoomStateCache
+from announcement.room_state import ANNOUNCEMENT_TYPE, RoomState
+from announcement.recipient_lists import GENERAL, LIVE, RecipientGroups, plan_shards, shard_state_key
+from announcement.admin_acl import AdminAcl
+from announcement.rate_limiter import RateLimiter, get_retry_after_ms, is_rate_limited
 
 ANNOUNCEMENT_STATE_EVENT = EventType.find("org.minbh.announcement", EventType.Class.STATE)
 
+T = TypeVar("T")
+
 
 if TYPE_CHECKING:
     from announcement.bot import Announcement
@@ -16,26 +24,83 @@ class RoomManager:
         self.announcement = announcement
         self.client = announcement.client
         self.log = announcement.log
+        self.state_cache = RoomStateCache(announcement.config.get("state_cache_size", 1000))
+        self.groups = RecipientGroups(announcement.config.get("groups", {}))
+        self.shard_size = max(1, announcement.config.get("shard_size", 500))
+        room_creation = announcement.config.get("room_creation", {}) or {}
+        # Room creation has its own budget on the homeserver, separate from sending messages
+        self.room_creation_limiter = RateLimiter(
+            rate=room_creation.get("per_second", 0.5),
+            burst=room_creation.get("burst", 5),
+            max_backoff=(announcement.config.get("rate_limit", {}) or {}).get("max_backoff", 60),
+        )
+        self.room_creation_retries = room_creation.get("max_retries", 5)
+        self._pending_rooms: Dict[Tuple[RoomID, str], "asyncio.Future[Optional[RoomID]]"] = {}
+        # (endpoint, room ID) -> request shared by every concurrent caller
+        self._in_flight: Dict[Tuple[str, str], asyncio.Task] = {}
+
+    async def _coalesce(self, endpoint: str, room_id: str, request: Callable[[], Awaitable[T]]) -> T:
+        """Run a homeserver read once for all concurrent callers asking for the same (endpoint, room)."""
+        key = (endpoint, room_id)
+        task = self._in_flight.get(key)
+        if task is None:
+            task = self._in_flight[key] = asyncio.ensure_future(request())
+
+            def forget(done: asyncio.Task) -> None:
+                if self._in_flight.get(key) is done:
+                    del self._in_flight[key]
+            task.add_done_callback(forget)
+        # Shielded so a cancelled caller doesn't cancel the request for the others
+        return await asyncio.shield(task)
+
+    async def get_joined_rooms(self) -> List[RoomID]:
+        return await self._coalesce("joined_rooms", "", self.client.get_joined_rooms)
 
-    async def create_or_join_private_room(self, user_id: str, announcement_room: RoomID, room_states: List[Dict[str, Any]]) -> Optional[RoomID]:
+    async def get_members(self, room_id: RoomID) -> List[StateEvent]:
+        return await self._coalesce("members", room_id, lambda: self.client.get_members(room_id))
+
+    async def get_joined_members(self, room_id: RoomID) -> List[str]:
+        """Return the MXIDs of the joined members of a room, for checks that don't need other memberships."""
+        members = await self._coalesce("joined_members", room_id, lambda: self.client.get_joined_members(room_id))
+        return list(members)
+
+    async def create_or_join_private_room(self, user_id: str, announcement_room: RoomID, room_state: RoomState) -> Optional[RoomID]:
         """Create or join a private room for a user."""
         existing_room_id = await self.get_existing_private_room(announcement_room, user_id)
         
         if existing_room_id:
-            self.log.warning(f"Found existing room: {existing_room_id}. Joining the room.")
+            self.log.debug(f"Found existing room: {existing_room_id}. Joining the room.")
             return existing_room_id
 
-        # Create a new private room if no existing room is found
-        topic =  self.extract_room_topic(room_states)
-        name =  self.extract_room_name(room_states)
-        avatar_url =  self.extract_room_avatar(room_states)
+        # Share a room creation that is already in flight for the same user
+        key = (announcement_room, user_id)
+        pending = self._pending_rooms.get(key)
+        if pending:
+            return await asyncio.shield(pending)
+        pending = self._pending_rooms[key] = asyncio.get_running_loop().create_future()
+        try:
+            room_id = await self.create_private_room(user_id, announcement_room, room_state)
+        except BaseException:
+            pending.cancel()
+            raise
+        finally:
+            del self._pending_rooms[key]
+        pending.set_result(room_id)
+        return room_id
 
-        custom_event = next((e for e in room_states if e.get("type") == 'm.room.encryption'), None)
-        is_room_encrypted = custom_event is not None
+    async def create_private_room(self, user_id: str, announcement_room: RoomID, room_state: RoomState) -> Optional[RoomID]:
+        """Create a new private receiver room for a user."""
+        # Create a new private room if no existing room is found
+        topic = room_state.topic
+        name = room_state.name
+        avatar_url = room_state.avatar_url
+        is_room_encrypted = room_state.encrypted
+        sender = self.announcement.queue_processor.senders.assign(announcement_room, user_id)
+        invitees = [user_id] if sender.is_main else [user_id, sender.user_id]
 
         room_options = {
             "visibility": RoomDirectoryVisibility.PRIVATE,
-            "invitees": [user_id],
+            "invitees": invitees,
             "preset": RoomCreatePreset.PRIVATE,
             "topic": topic,
             "name": name + " 📣",
@@ -61,6 +126,7 @@ class RoomManager:
                     "content": {
                         "users": {
                             self.client.mxid: 100,
+                            sender.user_id: 100,
                             user_id: 0,
                         },
                         "users_default": 0,
@@ -83,84 +149,193 @@ class RoomManager:
         #             "algorithm": "m.megolm.v1.aes-sha2"
         #         },
         #     })
-        try:
-            response = await self.client.create_room(**room_options)
-            self.log.warning(f"Room created: {response}")
-            return response
-        except Exception as e:
-            self.log.error(f"Failed to create room: {e}")
-            return None
+        attempt = 0
+        while True:
+            await self.room_creation_limiter.acquire()
+            try:
+                response = await self.client.create_room(**room_options)
+                self.room_creation_limiter.on_success()
+                self.log.debug(f"Room created: {response}")
+                break
+            except Exception as e:
+                if not is_rate_limited(e) or attempt >= self.room_creation_retries:
+                    self.log.error(f"Failed to create room: {e}")
+                    return None
+                attempt += 1
+                backoff = self.room_creation_limiter.on_rate_limited(get_retry_after_ms(e))
+                self.log.warning(f"Room creation for {user_id} was rate limited, retrying in {backoff:.1f}s")
+        sender_id = None
+        if not sender.is_main:
+            try:
+                await sender.client.join_room(response)
+                sender_id = sender.user_id
+            except Exception as e:
+                self.log.error(f"Sender {sender.user_id} failed to join {response}, the bot sends there instead: {e}")
+        await self.announcement.room_index.add(announcement_room, user_id, response, sender_id)
+        return response
 
     async def get_existing_private_room(self, announcement_room: RoomID, other_user_id: str) -> Optional[RoomID]:
-        """Check for existing private rooms with the specified user."""
-        bots_joined_rooms = await self.client.get_joined_rooms()
-        
-        for room_id in bots_joined_rooms:
+        """Look up the private room of the specified user in the receiver room index."""
+        await self.announcement.room_index.ready.wait()
+        return self.announcement.room_index.get(announcement_room, other_user_id)
+
+    async def warm_room_index(self) -> None:
+        """Load the receiver room index and drop the rooms the bot is no longer in.
+
+        If nothing is stored yet, the index is built by build_room_index in the
+        background. Lookups and membership updates wait until it is ready, so
+        events handled during start-up neither create duplicate rooms nor get lost.
+        """
+        room_index = self.announcement.room_index
+        cold = False
+        try:
+            await room_index.load()
+            bots_joined_rooms = set(await self.get_joined_rooms())
+
+            for room_id in [room_id for room_id in room_index.room_ids() if room_id not in bots_joined_rooms]:
+                self.log.debug(f"Dropping receiver room {room_id} the bot is no longer in")
+                await room_index.remove(room_id)
+            cold = len(room_index) == 0
+        finally:
+            # Receivers that left while the bot was offline arrive as leave events once syncing resumes
+            if not cold:
+                room_index.ready.set()
+
+    async def build_room_index(self) -> None:
+        """Build the receiver room index once from the joined rooms, if nothing was stored yet."""
+        room_index = self.announcement.room_index
+        if room_index.ready.is_set():
+            return
+        try:
+            bots_joined_rooms = await self.get_joined_rooms()
+            semaphore = asyncio.Semaphore(self.announcement.config.get("reconcile_concurrency", 10))
+            await asyncio.gather(*(self.index_joined_room(room_id, semaphore) for room_id in bots_joined_rooms))
+            self.log.info(f"Indexed {len(room_index)} receiver rooms")
+        finally:
+            room_index.ready.set()
+
+    async def index_joined_room(self, room_id: RoomID, semaphore: asyncio.Semaphore) -> None:
+        async with semaphore:
             try:
-                member_events = await self.client.get_members(room_id)
-                self.log.debug(f"Member events count: {len(member_events)}")
-                if len(member_events) == 2 and other_user_id in [evt.state_key for evt in member_events]:
-                    room_state = await self.fetch_room_state(room_id)
-
-                    if self.extract_room_matches_announcement_receiver(announcement_room, room_state):
-                        membership = next(
-                            (evt.content.get('membership') for evt in member_events if evt.state_key == other_user_id),
-                            None
-                        )
-                        self.log.warning(f"Membership type for {other_user_id}: {membership}")
-
-                        if membership in [Membership.JOIN, Membership.INVITE]:
-                            self.log.warning(f"Returning room ID: {room_id}")
-                            return room_id
-                        else:
-                            await self.client.leave_room(room_id, "")
-                            self.log.warning(f"Left empty room {room_id}.")
-
-                self.log.debug("No matching room found")
+                member_events, sender = self.split_sender(await self.get_members(room_id))
+                if len(member_events) != 2:
+                    return
+                room_state = await self.fetch_room_state(room_id)
+                announcement_room = self.extract_receiver_announcement_room(room_state)
+                if not announcement_room:
+                    return
+                other_member = next((evt for evt in member_events if evt.state_key != self.client.mxid), None)
+                if not other_member:
+                    return
+                if other_member.content.membership in [Membership.JOIN, Membership.INVITE]:
+                    await self.announcement.room_index.add(announcement_room, other_member.state_key, room_id, sender)
+                else:
+                    await self.client.leave_room(room_id, "")
+                    self.log.warning(f"Left empty room {room_id}.")
             except Exception as e:
-                self.log.error(f"Failed to get members: {e}")
-                continue
-        return None
+                self.log.error(f"Failed to index room {room_id}: {e}")
+
+    async def update_room_index_from_member(self, evt: StateEvent) -> None:
+        """Drop receiver rooms from the index once the receiving user is gone."""
+        await self.announcement.room_index.ready.wait()
+        if evt.content.membership in [Membership.JOIN, Membership.INVITE]:
+            return
+        await self.drop_member(evt.room_id, evt.state_key)
+
+    async def drop_member(self, room_id: RoomID, user_id: str) -> None:
+        """Handle the receiver or the sender account of a receiver room no longer being in it."""
+        room_index = self.announcement.room_index
+        key = room_index.get_key(room_id)
+        if not key:
+            return
+        if user_id == room_index.get_sender(room_id):
+            await room_index.clear_sender(room_id)
+            return
+        if user_id != key[1]:
+            return
+        sender = self.announcement.queue_processor.senders.for_room(room_id)
+        await room_index.remove(room_id)
+        clients = [self.client] if sender.is_main else [sender.client, self.client]
+        for client in clients:
+            try:
+                await client.leave_room(room_id, "")
+                self.log.warning(f"{client.mxid} left empty room {room_id}.")
+            except Exception as e:
+                self.log.error(f"{client.mxid} failed to leave room {room_id}: {e}")
+
+    async def update_room_index_from_receiver(self, evt: StateEvent) -> None:
+        """Index receiver rooms announced through org.minbh.announcement.receiver state."""
+        room_index = self.announcement.room_index
+        announcement_room = evt.content.get("announcement_room_id", "")
+        if evt.sender != self.client.mxid or not announcement_room:
+            return
+        await room_index.ready.wait()
+        key = room_index.get_key(evt.room_id)
+        if key and key[0] == announcement_room:
+            return
+        try:
+            member_events, sender = self.split_sender(await self.get_members(evt.room_id))
+            other_member = next(
+                (member for member in member_events
+                 if member.state_key != self.client.mxid
+                 and member.content.membership in [Membership.JOIN, Membership.INVITE]),
+                None
+            )
+            if other_member:
+                await room_index.add(announcement_room, other_member.state_key, evt.room_id, sender)
+        except Exception as e:
+            self.log.error(f"Failed to index receiver room {evt.room_id}: {e}")
+
+    def split_sender(self, member_events: List[StateEvent]) -> Tuple[List[StateEvent], Optional[str]]:
+        """Separate extra sender accounts from the members of a receiver room.
+
+        Returns the remaining members and the joined sender account, if any.
+        """
+        senders = self.announcement.queue_processor.senders
+        members = [evt for evt in member_events if not senders.is_pool_member(evt.state_key)]
+        sender = next((evt.state_key for evt in member_events
+                       if senders.is_pool_member(evt.state_key) and evt.content.membership == Membership.JOIN), None)
+        return members, sender
 
     async def update_user_room_general_members(self, room_id: RoomID, admin_id: str, config: Dict[str, Any]) -> None:
         try:
             room_state = await self.fetch_room_state(room_id)
             
             # Check if this is an announcer---bot room
-            if self.extract_room_matches_announcement_receiver(room_id, room_state):
+            if self.announcement.room_index.is_receiver_room(room_id):
                 return
 
-            if self.extract_bot_power(room_state) < 50:
+            if room_state.user_power(self.client.mxid) < 50:
                 return
             
-            user_groups = self.get_general_users_for_admin(config, admin_id)
-            
-            # Get existing Live members from room state
-            existing_live_users =  self.extract_annoucment_members(room_state) or []
+            admin_acl = self.announcement.admin_acl
+            user_groups = admin_acl.general_users(admin_id)
 
             filtered_live_users = []
             # Check if minbh is None in the room_state
-            if not self.check_already_minbh_in_room_state(room_state):
+            if not room_state.has_announcement:
                 filtered_live_users = user_groups
             else:
-                filtered_live_users = [user for user in existing_live_users if user in user_groups]
-                        
+                # Raw entries: users and "+group" references stay as long as General covers them
+                filtered_live_users = [user for user in room_state.entries(LIVE)
+                                       if admin_acl.is_general_user(admin_id, user)]
+
             # Prepare updated state content
             updated_state = {
-                "General": user_groups,  # Update General users
-                "Live": filtered_live_users  # Update filtered Live users
+                GENERAL: user_groups,  # Update General users
+                LIVE: filtered_live_users  # Update filtered Live users
             }
-            
-            # Send the updated state event
-            await self.client.send_state_event(
-                room_id,
-                "org.minbh.announcement",
-                updated_state
-            )
+
+            # Send only the shards whose content changed
+            changes = self.plan_announcement_state(room_state, updated_state)
+            if not changes:
+                self.log.debug(f"Announcement state of {room_id} is up to date")
+            for state_key, content in changes:
+                await self.client.send_state_event(room_id, ANNOUNCEMENT_STATE_EVENT, content, state_key=state_key)
             widget_url = config.get("widget_url", "")
-            self.log.warning(f"widget url  {widget_url} ")
+            self.log.debug(f"widget url  {widget_url} ")
 
-            if widget_url and not self.is_widget_registered(room_state):  # Check if widget_url is not blank
+            if widget_url and not room_state.widget_registered:  # Check if widget_url is not blank
                 # Update widget state
                 widget_state = {
                     "type": "com.minbh.announcement",
@@ -180,132 +355,112 @@ class RoomManager:
                     state_key=random_id
                 )
             
-            self.log.warning(f"Updated room state for {updated_state} ")
+            self.log.debug(f"Updated room state for {updated_state} ")
                 
         except Exception as e:
             self.log.error(f"Failed to update room state for room {room_id}: {e}")
 
+    def plan_announcement_state(self, room_state: RoomState,
+                                lists: Dict[str, List[str]]) -> List[Tuple[str, Dict[str, Any]]]:
+        """Return the (state key, content) writes that bring the sharded recipient lists to the given lists.
+
+        Shard 0 of every list stays inline in the "" event, so rooms with short
+        lists keep the original single-event layout. Shards are capped in bytes
+        as well as entries, which keeps the "" event with both lists under the
+        event size limit. Extra shards are written before the "" event so a
+        reader never misses a user while lists grow.
+        """
+        changes = []
+        root = dict(room_state.content(ANNOUNCEMENT_TYPE))
+        root_changed = not room_state.has_announcement
+        for list_name, entries in lists.items():
+            existing_count = room_state.shard_count(list_name)
+            shards = plan_shards(entries, existing_count, self.shard_size)
+            for index, shard in enumerate(shards):
+                if index == 0:
+                    if room_state.shard(list_name, 0) != tuple(shard) or list_name not in root:
+                        root[list_name] = shard
+                        root_changed = True
+                # New shards are written even when empty so the shard count, and with it placement, sticks
+                elif index >= existing_count or room_state.shard(list_name, index) != tuple(shard):
+                    changes.append((shard_state_key(list_name, index), {"users": shard}))
+        if root_changed:
+            changes.append(("", root))
+        return changes
+
     async def update_room_general_members(self, config: Dict[str, Any]) -> None:
+        """Reconcile the announcement state of every admin room the bot is in, concurrently."""
+        bots_joined_rooms = await self.get_joined_rooms()
+        room_index = self.announcement.room_index
+        admin_acl = self.announcement.admin_acl
+        semaphore = asyncio.Semaphore(config.get("reconcile_concurrency", 10))
 
-        bots_joined_rooms = await self.client.get_joined_rooms()
-        
-        for room_id in bots_joined_rooms:
-            try:
-                
-                # Get all members in the room
-                member_events = await self.client.get_members(room_id)
-                member_ids = [evt.state_key for evt in member_events]
+        # Receiver rooms are known from the index and never need reconciling
+        candidate_rooms = [room_id for room_id in bots_joined_rooms if not room_index.is_receiver_room(room_id)]
+        self.log.debug(f"Reconciling {len(candidate_rooms)} of {len(bots_joined_rooms)} joined rooms")
+        await asyncio.gather(*(
+            self.update_room_general_members_in_room(room_id, admin_acl, config, semaphore)
+            for room_id in candidate_rooms
+        ))
 
-                
+    async def update_room_general_members_in_room(self, room_id: RoomID, admin_acl: AdminAcl, config: Dict[str, Any],
+                                                  semaphore: asyncio.Semaphore) -> None:
+        async with semaphore:
+            try:
+                # Get the joined members in the room
+                member_ids = await self.get_joined_members(room_id)
 
                 # Skip if not a private room (more than 2 members)
                 if len(member_ids) != 2:
-                    self.log.debug(f"member_ids: {len(member_ids)}")                    
-                    continue
-                    
+                    self.log.debug(f"member_ids: {len(member_ids)}")
+                    return
+
                 # Find the other user in the room (excluding our bot)
                 bot_previledged_user = next((uid for uid in member_ids if uid != self.client.mxid), None)
                 self.log.debug(f"bot previledged: {bot_previledged_user}")
                 if not bot_previledged_user:
-                    continue
+                    return
+
+                if not admin_acl.is_admin(bot_previledged_user):
+                    return
 
-                if bot_previledged_user not in self.get_admin_users(config):
-                    continue
-                
                 await self.update_user_room_general_members(room_id, bot_previledged_user, config)
-                self.log.warning(f"Updated room state for {bot_previledged_user} in room {room_id}")
-                
+                self.log.debug(f"Reconciled room state for {bot_previledged_user} in room {room_id}")
+
             except Exception as e:
                 self.log.error(f"Failed to update room state for room {room_id}: {e}")
-                continue
 
-    async def fetch_room_state(self, room_id: RoomID) -> List[Dict[str, Any]]:
-        """Fetch the full state of the room."""
-        response = await self.client.api.request(Method.GET, Path.v3.rooms[room_id].state)
-        return response
+    async def fetch_room_state(self, room_id: RoomID) -> RoomState:
+        """Fetch the full state of the room, served from the state cache when possible."""
+        cached = self.state_cache.get(room_id)
+        if cached is not None:
+            return cached
+        return await self._coalesce("state", room_id, lambda: self._request_room_state(room_id))
 
-    def extract_room_topic(self, state_events) -> str:
-        """Extract the room topic from the state events."""
-        topic_event = next((e for e in state_events if e["type"] == "m.room.topic"), None)
-        return topic_event["content"].get("topic", "") if topic_event else ""
-    
-    def is_widget_registered(self, room_state) -> bool:
-        """Check if any widget in room_state is of type 'com.minbh.announcement'."""
-        return any(
-            e.get("type") == "im.vector.modular.widgets" and
-            e.get("content", {}).get("type") == "com.minbh.announcement"
-            for e in room_state
-        )
-
-    def extract_bot_power(self, room_state) -> int:
-        """Extract the power level of sai3 from the state events."""
-        power_levels = next((e for e in room_state if e["type"] == "m.room.power_levels"), None)
-        if not power_levels:
-            return -1  
-        
-        users = power_levels.get("content", {}).get("users", {})
-        return users.get(self.client.mxid, 0) 
-    
-    def check_already_minbh_in_room_state(self, room_state) -> bool:
-        """Check if minbh is None in the room_state."""
-        minbh = next((e for e in room_state if e["type"] == "org.minbh.announcement"), None)
-        return minbh is not None
-    
-    def extract_annoucment_members(self, room_state) -> List:
-        """Extract the room avatar from the state events."""
-        minbh = next((e for e in room_state if e["type"] == "org.minbh.announcement"), None)
-        self.log.warning(f"extract members {minbh["content"].get("Live", []) if minbh else ""}.")
-        return minbh["content"].get("Live", []) if minbh else ""
-
-    def extract_room_avatar(self, state_events) -> str:
-        """Extract the room avatar from the state events."""
-        avatar_event = next((e for e in state_events if e["type"] == "m.room.avatar"), None)
-        return avatar_event["content"].get("url", "") if avatar_event else ""
-
-    def extract_room_name(self, state_events) -> str:
-        """Extract the room name from the state events."""
-        name_event = next((e for e in state_events if e["type"] == "m.room.name"), None)
-        return name_event["content"].get("name", "") if name_event else ""
-
-    def extract_room_matches_announcement_receiver(self, announcement_room_id, state_events) -> bool:
-        """Check if the room matches the announcement criteria."""
-        custom_event = next((e for e in state_events if e["type"] == "org.minbh.announcement.receiver"), None)
-        if custom_event:
-            self.log.warning(f"Room ID match {custom_event['content'].get('announcement_room_id', '')}.")
-            return custom_event["content"].get("announcement_room_id", "") == announcement_room_id
-        return False
-    
-    def extract_room_members(self, state_events) -> bool:
-        """Check if the room matches the announcement criteria."""
-        custom_event = next((e for e in state_events if e["type"] == "m.room.member"), None)
-        if custom_event:
-            self.log.warning(f"Extract room members {custom_event}.")
-            self.log.warning(f"Extract room members {custom_event['content']}.")
-            return  False
-        return False
-    
-        
-    def get_admin_users(self, config: Dict[str, Any]) -> List[str]:
-        try:
-            admin_config = config.get("admins", [])
-            return [admin["user"] for admin in admin_config if "user" in admin]
-        except Exception as e:
-            self.log.error(f"Error getting admin users: {e}")
-            return []
-    
-    def get_general_users_for_admin(self, config: Dict[str, Any], admin_id: str) -> List[str]:
+    async def _request_room_state(self, room_id: RoomID) -> RoomState:
+        self.state_cache.begin_fetch(room_id)
         try:
-            admin_config = config.get("admins", [])
-            admin_data = next(
-                (admin for admin in admin_config 
-                if admin.get("user") == admin_id),
-                None
-            )
-            
-            if admin_data:
-                return admin_data.get("general", [])
-            return []
-        
-        except Exception as e:
-            self.log.error(f"Error getting general users for admin {admin_id}: {e}")
-            return []
\ No newline at end of file
+            response = await self.client.api.request(Method.GET, Path.v3.rooms[room_id].state)
+        except BaseException:
+            self.state_cache.abort_fetch(room_id)
+            raise
+        room_state = RoomState(response, self.groups)
+        self.state_cache.put(room_id, room_state)
+        return room_state
+
+    def update_state_cache(self, evt) -> None:
+        """Keep cached room state current from the events the bot receives."""
+        if isinstance(evt, StateEvent):
+            if evt.type == EventType.ROOM_MEMBER and evt.state_key == self.client.mxid \
+                    and evt.content.membership in [Membership.LEAVE, Membership.BAN]:
+                self.state_cache.invalidate(evt.room_id)
+                return
+            self.state_cache.apply(evt.room_id, evt.serialize())
+        elif isinstance(evt, RedactionEvent):
+            self.state_cache.invalidate_event(evt.room_id, evt.redacts)
+
+    def extract_receiver_announcement_room(self, room_state: RoomState) -> Optional[RoomID]:
+        """Return the announcement room a receiver room was created for by the bot."""
+        if room_state.receiver_sender == self.client.mxid:
+            return room_state.receiver_room_id
+        return None
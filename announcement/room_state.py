@@ -0,0 +1,177 @@
+from typing import Any, Dict, FrozenSet, Iterable, Optional, Tuple
+
+from announcement.recipient_lists import GENERAL, LISTS, LIVE, RecipientGroups, parse_shard_state_key
+
+ANNOUNCEMENT_TYPE = "org.minbh.announcement"
+RECEIVER_TYPE = "org.minbh.announcement.receiver"
+WIDGET_TYPE = "im.vector.modular.widgets"
+ANNOUNCEMENT_WIDGET_TYPE = "com.minbh.announcement"
+
+StateKey = Tuple[str, str]
+
+
+class RoomState:
+    """Parsed room state indexed by (type, state_key) with the fields the bot reads precomputed.
+
+    The Live and General lists may be sharded over several announcement
+    state keys and reference config groups; they are merged and expanded on
+    first use after a change.
+    """
+
+    __slots__ = (
+        "_events",
+        "_announcement_widgets",
+        "name",
+        "topic",
+        "avatar_url",
+        "power_levels",
+        "encrypted",
+        "has_announcement",
+        "groups",
+        "_shards",
+        "_merged",
+        "_live",
+        "receiver_room_id",
+        "receiver_sender",
+    )
+
+    _events: Dict[StateKey, Dict[str, Any]]
+    _announcement_widgets: set
+    name: str
+    topic: str
+    avatar_url: str
+    power_levels: Optional[Dict[str, Any]]
+    encrypted: bool
+    has_announcement: bool
+    groups: RecipientGroups
+    _shards: Dict[str, Dict[int, Tuple[str, ...]]]
+    _merged: Dict[str, Tuple[str, ...]]
+    _live: Optional[FrozenSet[str]]
+    receiver_room_id: Optional[str]
+    receiver_sender: Optional[str]
+
+    def __init__(self, state_events: Iterable[Dict[str, Any]] = (), groups: Optional[RecipientGroups] = None):
+        self._events = {}
+        self._announcement_widgets = set()
+        self.name = ""
+        self.topic = ""
+        self.avatar_url = ""
+        self.power_levels = None
+        self.encrypted = False
+        self.has_announcement = False
+        self.groups = groups or RecipientGroups()
+        self._shards = {list_name: {} for list_name in LISTS}
+        self._merged = {}
+        self._live = None
+        self.receiver_room_id = None
+        self.receiver_sender = None
+        for event in state_events:
+            self.apply(event)
+
+    def __len__(self) -> int:
+        return len(self._events)
+
+    def __iter__(self):
+        return iter(self._events.values())
+
+    def get(self, event_type: str, state_key: str = "") -> Optional[Dict[str, Any]]:
+        """Return the raw state event for (type, state_key), if present."""
+        return self._events.get((event_type, state_key))
+
+    def content(self, event_type: str, state_key: str = "") -> Dict[str, Any]:
+        event = self._events.get((event_type, state_key))
+        return (event.get("content") or {}) if event else {}
+
+    @property
+    def widget_registered(self) -> bool:
+        return len(self._announcement_widgets) > 0
+
+    def entries(self, list_name: str) -> Tuple[str, ...]:
+        """Return a recipient list merged over its shards, with group references left as they are."""
+        seen = set()
+        entries = []
+        shards = self._shards[list_name]
+        for index in sorted(shards):
+            for entry in shards[index]:
+                if entry not in seen:
+                    seen.add(entry)
+                    entries.append(entry)
+        return tuple(entries)
+
+    def shard(self, list_name: str, index: int) -> Tuple[str, ...]:
+        return self._shards[list_name].get(index, ())
+
+    def shard_count(self, list_name: str) -> int:
+        return max(self._shards[list_name], default=0) + 1
+
+    def users(self, list_name: str) -> Tuple[str, ...]:
+        """Return a recipient list merged over its shards with groups expanded."""
+        merged = self._merged.get(list_name)
+        if merged is None:
+            merged = self._merged[list_name] = self.groups.expand(self.entries(list_name))
+        return merged
+
+    @property
+    def live_users(self) -> Tuple[str, ...]:
+        return self.users(LIVE)
+
+    @property
+    def general_users(self) -> Tuple[str, ...]:
+        return self.users(GENERAL)
+
+    @property
+    def live(self) -> FrozenSet[str]:
+        if self._live is None:
+            self._live = frozenset(self.live_users)
+        return self._live
+
+    def _set_shard(self, list_name: str, index: int, entries: Iterable[str]) -> None:
+        self._shards[list_name][index] = tuple(entries)
+        self._merged.pop(list_name, None)
+        if list_name == LIVE:
+            self._live = None
+
+    def user_power(self, user_id: str) -> int:
+        """Return the power level of a user, or -1 if the room has no power levels."""
+        if self.power_levels is None:
+            return -1
+        return self.power_levels.get("users", {}).get(user_id, 0)
+
+    def contains_event(self, event_id: str) -> bool:
+        return any(e.get("event_id") == event_id for e in self._events.values())
+
+    def apply(self, event: Dict[str, Any]) -> None:
+        """Apply a state event, updating only the fields derived from its type."""
+        event_type = event["type"]
+        state_key = event.get("state_key", "")
+        self._events[(event_type, state_key)] = event
+        content = event.get("content") or {}
+
+        if event_type == WIDGET_TYPE:
+            if content.get("type") == ANNOUNCEMENT_WIDGET_TYPE:
+                self._announcement_widgets.add(state_key)
+            else:
+                self._announcement_widgets.discard(state_key)
+        elif event_type == ANNOUNCEMENT_TYPE and state_key != "":
+            shard = parse_shard_state_key(state_key)
+            if shard is not None:
+                self._set_shard(shard[0], shard[1], content.get("users", []))
+        elif state_key != "":
+            return
+        elif event_type == "m.room.name":
+            self.name = content.get("name", "")
+        elif event_type == "m.room.topic":
+            self.topic = content.get("topic", "")
+        elif event_type == "m.room.avatar":
+            self.avatar_url = content.get("url", "")
+        elif event_type == "m.room.power_levels":
+            self.power_levels = content
+        elif event_type == "m.room.encryption":
+            self.encrypted = True
+        elif event_type == ANNOUNCEMENT_TYPE:
+            self.has_announcement = True
+            for list_name in LISTS:
+                self._set_shard(list_name, 0, content.get(list_name, []))
+        elif event_type == RECEIVER_TYPE:
+            self.receiver_room_id = content.get("announcement_room_id") or None
+            self.receiver_sender = event.get("sender")
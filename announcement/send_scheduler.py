@@ -0,0 +1,211 @@
+import asyncio
+import heapq
+from collections import deque
+from typing import Any, Callable, Deque, Dict, Iterable, List, Optional, Set, Tuple
+
+from announcement.rate_limiter import RateLimiter
+
+QueueEntry = Tuple[int, int, Dict[str, Any]]
+
+
+class Partition:
+    """Pending sends for one destination, with its own backoff state and the bucket of the account sending them."""
+
+    __slots__ = ("key", "entries", "backoff", "account", "blocked", "in_flight", "ready_at", "unblock_handle")
+
+    def __init__(self, key: str, backoff: RateLimiter, account: Optional[RateLimiter] = None):
+        self.key = key
+        self.entries: List[QueueEntry] = []
+        self.backoff = backoff
+        self.account = account
+        self.blocked = False
+        self.in_flight = 0
+        # Priorities whose ready list currently holds this partition
+        self.ready_at: Set[int] = set()
+        self.unblock_handle: Optional[asyncio.TimerHandle] = None
+
+    def head_priority(self) -> int:
+        return self.entries[0][0]
+
+
+class SendScheduler:
+    """Partitioned priority queue served round-robin across destinations.
+
+    Each partition keeps its entries in a heap ordered by (priority,
+    sequence). Ready partitions wait in one FIFO per priority of their head
+    entry. Priority classes share the send budget by weight (stride
+    scheduling: the class with the lowest virtual time is served next and
+    advances by 1/weight), so urgent traffic overtakes bulk traffic without
+    starving it. Within a class, workers pop one entry from the partition at
+    the front and put it back at the end of the line. Paused classes are not
+    served at all. A partition
+    backing off after a 429 is left out until its backoff expires, so it does
+    not hold up sends to other destinations. Cancelled entries stay in their
+    heap and are skipped when they reach the top.
+
+    A partition is only served when the token bucket of its account has a
+    token, which get() takes on the caller's behalf. Partitions of an account
+    that is out of tokens or blocked after a 429 are parked until it has one
+    again, so workers keep serving the other accounts instead of waiting on
+    the slowest bucket.
+    """
+
+    def __init__(self, make_backoff: Callable[[], RateLimiter], weights: Optional[Dict[int, float]] = None):
+        self.make_backoff = make_backoff
+        self.weights = weights or {}
+        self.partitions: Dict[str, Partition] = {}
+        self._ready: Dict[int, Deque[Partition]] = {}
+        self._paused: Set[int] = set()
+        self._pass: Dict[int, float] = {}
+        self._virtual_time = 0.0
+        self._wakeup = asyncio.Event()
+        self._size = 0
+        self._cancelled: Set[int] = set()
+        # Account bucket -> partitions waiting for it to have a token, and the timer that releases them
+        self._parked: Dict[RateLimiter, List[Partition]] = {}
+        self._unpark_handles: Dict[RateLimiter, asyncio.TimerHandle] = {}
+
+    def __len__(self) -> int:
+        return self._size
+
+    def put(self, key: str, entry: QueueEntry, account: Optional[RateLimiter] = None) -> None:
+        """Queue an entry for a destination. account is the token bucket of the account that sends to it."""
+        partition = self.partitions.get(key)
+        if partition is None:
+            partition = self.partitions[key] = Partition(key, self.make_backoff(), account)
+        heapq.heappush(partition.entries, entry)
+        self._size += 1
+        self._make_ready(partition)
+
+    def _make_ready(self, partition: Partition) -> None:
+        if partition.blocked or not partition.entries:
+            return
+        priority = partition.head_priority()
+        if priority in partition.ready_at:
+            return
+        partition.ready_at.add(priority)
+        self._ready.setdefault(priority, deque()).append(partition)
+        self._wakeup.set()
+
+    def pause(self, priority: int) -> None:
+        self._paused.add(priority)
+
+    def resume(self, priority: int) -> None:
+        if priority in self._paused:
+            self._paused.discard(priority)
+            self._wakeup.set()
+
+    def _pop_ready(self) -> Optional[Partition]:
+        while True:
+            classes = [priority for priority, ready in self._ready.items() if ready and priority not in self._paused]
+            if not classes:
+                return None
+            priority = min(classes, key=lambda p: (self._pass.get(p, self._virtual_time), p))
+            ready = self._ready[priority]
+            while ready:
+                partition = ready.popleft()
+                partition.ready_at.discard(priority)
+                # Entries are dropped lazily: skip partitions that went empty, got blocked or changed head
+                if partition.blocked or not partition.entries or partition.head_priority() != priority:
+                    self._make_ready(partition)
+                    continue
+                if partition.account is not None:
+                    wait = partition.account.available_in()
+                    if wait > 0:
+                        self._park(partition, wait)
+                        continue
+                # A class that was idle starts at the current virtual time instead of claiming a backlog of turns
+                start = max(self._pass.get(priority, 0.0), self._virtual_time)
+                self._virtual_time = start
+                self._pass[priority] = start + 1 / self.weights.get(priority, 1)
+                return partition
+
+    def _park(self, partition: Partition, wait: float) -> None:
+        account = partition.account
+        self._parked.setdefault(account, []).append(partition)
+        if account not in self._unpark_handles:
+            self._unpark_handles[account] = asyncio.get_running_loop().call_later(wait, self._unpark, account)
+
+    def _unpark(self, account: RateLimiter) -> None:
+        del self._unpark_handles[account]
+        for partition in self._parked.pop(account, []):
+            self._make_ready(partition)
+
+    def _pop_entry(self, partition: Partition) -> Optional[QueueEntry]:
+        while partition.entries:
+            entry = heapq.heappop(partition.entries)
+            if entry[1] in self._cancelled:
+                self._cancelled.discard(entry[1])
+                continue
+            self._size -= 1
+            return entry
+        return None
+
+    async def get(self) -> Tuple[Partition, QueueEntry]:
+        """Wait for the next entry, taking turns between the ready partitions."""
+        while True:
+            partition = self._pop_ready()
+            if partition is None:
+                self._wakeup.clear()
+                await self._wakeup.wait()
+                continue
+            entry = self._pop_entry(partition)
+            if entry is not None:
+                break
+            # Only cancelled entries were left
+            self._forget_if_idle(partition)
+        if partition.account is not None:
+            partition.account.reserve()
+        partition.in_flight += 1
+        self._make_ready(partition)
+        return partition, entry
+
+    def cancel(self, sequences: Iterable[int]) -> None:
+        """Drop queued entries by sequence number without searching the heaps."""
+        for sequence in sequences:
+            self._cancelled.add(sequence)
+            self._size -= 1
+
+    def done(self, partition: Partition) -> None:
+        """Mark an entry taken by get() as handled and forget the partition once it is idle."""
+        partition.in_flight -= 1
+        self._forget_if_idle(partition)
+
+    def _forget_if_idle(self, partition: Partition) -> None:
+        if (not partition.entries and not partition.in_flight and not partition.blocked
+                and not partition.backoff.consecutive_rate_limits):
+            if self.partitions.get(partition.key) is partition:
+                del self.partitions[partition.key]
+
+    def retry(self, partition: Partition, entry: QueueEntry, retry_after_ms: Optional[int] = None) -> float:
+        """Put a rate limited entry back and block its partition for the backoff. Returns the backoff."""
+        backoff = partition.backoff.on_rate_limited(retry_after_ms)
+        heapq.heappush(partition.entries, entry)
+        self._size += 1
+        if not partition.blocked:
+            partition.blocked = True
+            partition.unblock_handle = asyncio.get_running_loop().call_later(backoff, self._unblock, partition)
+        return backoff
+
+    def _unblock(self, partition: Partition) -> None:
+        remaining = partition.backoff.blocked_for()
+        if remaining > 0:
+            # Another 429 extended the backoff while this timer was pending
+            partition.unblock_handle = asyncio.get_running_loop().call_later(remaining, self._unblock, partition)
+            return
+        partition.unblock_handle = None
+        partition.blocked = False
+        self._make_ready(partition)
+
+    def close(self) -> None:
+        """Cancel the timers that would unblock or unpark partitions later."""
+        for partition in self.partitions.values():
+            if partition.unblock_handle is not None:
+                partition.unblock_handle.cancel()
+                partition.unblock_handle = None
+        for handle in self._unpark_handles.values():
+            handle.cancel()
+        self._unpark_handles.clear()
+
+    def blocked(self) -> Iterable[Partition]:
+        return (partition for partition in self.partitions.values() if partition.blocked)
@@ -0,0 +1,99 @@
+import zlib
+from mautrix.client import Client
+from mautrix.types import RoomID, UserID
+from typing import Dict, Optional, Set
+from typing import TYPE_CHECKING
+
+from announcement.rate_limiter import RateLimiter, keep_retry_after
+
+if TYPE_CHECKING:
+    from announcement.bot import Announcement
+
+
+class Sender:
+    """An account deliveries are sent from, with its own rate limit."""
+
+    __slots__ = ("user_id", "client", "rate_limiter", "is_main")
+
+    def __init__(self, user_id: UserID, client: Client, rate_limiter: RateLimiter, is_main: bool = False):
+        self.user_id = user_id
+        self.client = client
+        self.rate_limiter = rate_limiter
+        self.is_main = is_main
+
+
+class SenderPool:
+    """The bot account plus the extra accounts from the `senders` config section.
+
+    Each new receiver room is assigned to one account by rendezvous hashing,
+    so adding or removing an account only moves the rooms that hash to it.
+    Rooms remember their account in the room index; rooms without one, or
+    whose account is no longer configured, are served by the bot itself.
+    """
+
+    def __init__(self, announcement: 'Announcement', rate_limiter: RateLimiter):
+        self.announcement = announcement
+        self.log = announcement.log
+        self.main = Sender(announcement.client.mxid, announcement.client, rate_limiter, is_main=True)
+        self.senders: Dict[UserID, Sender] = {self.main.user_id: self.main}
+        # Every configured account, including ones that failed to log in, so their rooms are still recognized
+        self.pool_members: Set[str] = set()
+
+    def __len__(self) -> int:
+        return len(self.senders)
+
+    def __iter__(self):
+        return iter(self.senders.values())
+
+    async def start(self) -> None:
+        """Log in the configured sender accounts, leaving out any whose token doesn't work."""
+        main_limiter = self.main.rate_limiter
+        for sender_config in self.announcement.config.get("senders", []) or []:
+            user_id = sender_config.get("user_id")
+            if not user_id or user_id in self.senders:
+                continue
+            self.pool_members.add(user_id)
+            client = Client(
+                mxid=user_id,
+                base_url=sender_config.get("homeserver") or self.announcement.client.api.base_url,
+                token=sender_config.get("access_token", ""),
+                client_session=self.announcement.client.api.session,
+                log=self.log.getChild(user_id),
+            )
+            keep_retry_after(client.api)
+            try:
+                whoami = await client.whoami()
+            except Exception as e:
+                self.log.error(f"Ignoring sender {user_id}: {e}")
+                continue
+            if whoami.user_id != user_id:
+                self.log.error(f"Ignoring sender {user_id}: the access token belongs to {whoami.user_id}")
+                continue
+            rate_limiter = RateLimiter(
+                rate=sender_config.get("per_second", main_limiter.rate),
+                burst=sender_config.get("burst", main_limiter.burst),
+                max_backoff=main_limiter.max_backoff,
+            )
+            self.senders[user_id] = Sender(user_id, client, rate_limiter)
+        if len(self.senders) > 1:
+            self.log.info(f"Sending deliveries from {len(self.senders)} accounts")
+
+    def is_pool_member(self, user_id: str) -> bool:
+        """Check whether a user is one of the extra sender accounts."""
+        return user_id in self.pool_members
+
+    def assign(self, announcement_room: RoomID, user_id: UserID) -> Sender:
+        """Pick the account that sends to a new receiver room."""
+        key = f"{announcement_room}|{user_id}"
+        # crc32 rather than hash() so the choice survives restarts
+        return max(self.senders.values(),
+                   key=lambda sender: (zlib.crc32(f"{sender.user_id}|{key}".encode("utf-8")), sender.user_id))
+
+    def get(self, user_id: Optional[str]) -> Optional[Sender]:
+        """Return a sender account by user ID, or the bot for None. Unknown accounts give None."""
+        return self.senders.get(user_id) if user_id else self.main
+
+    def for_room(self, room_id: RoomID) -> Sender:
+        """Return the account that sends to a room."""
+        sender_id = self.announcement.room_index.get_sender(room_id)
+        return self.senders.get(sender_id, self.main) if sender_id else self.main
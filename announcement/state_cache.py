@@ -0,0 +1,99 @@
+from collections import OrderedDict
+from mautrix.types import RoomID
+from typing import Any, Dict, List, Optional
+from announcement.room_state import RoomState
+
+
+class RoomStateCache:
+    """Bounded LRU cache of full room state, kept current from incoming state events.
+
+    State events for a room whose state is being fetched are recorded and
+    replayed over the response, which may predate them.
+    """
+
+    def __init__(self, max_size: int = 1000):
+        self.max_size = max_size
+        self.hits = 0
+        self.misses = 0
+        self._rooms: "OrderedDict[RoomID, RoomState]" = OrderedDict()
+        # Rooms being fetched -> state events received meanwhile, or None if the response must not be cached
+        self._fetching: Dict[RoomID, Optional[List[Dict[str, Any]]]] = {}
+
+    def __len__(self) -> int:
+        return len(self._rooms)
+
+    def __contains__(self, room_id: RoomID) -> bool:
+        return room_id in self._rooms
+
+    def get(self, room_id: RoomID) -> Optional[RoomState]:
+        """Return the cached state of a room, counting the lookup as a hit or miss."""
+        room_state = self._rooms.get(room_id)
+        if room_state is None:
+            self.misses += 1
+            return None
+        self.hits += 1
+        self._rooms.move_to_end(room_id)
+        return room_state
+
+    def begin_fetch(self, room_id: RoomID) -> None:
+        """Start recording the state events of a room until its fetched state is put()."""
+        self._fetching.setdefault(room_id, [])
+
+    def abort_fetch(self, room_id: RoomID) -> None:
+        self._fetching.pop(room_id, None)
+
+    def put(self, room_id: RoomID, room_state: RoomState) -> None:
+        """Store freshly fetched room state, evicting the least recently used room if full.
+
+        Events recorded since begin_fetch() are applied first. If the room was
+        invalidated meanwhile, the state is not stored.
+        """
+        events = self._fetching.pop(room_id, [])
+        if events is None:
+            return
+        for event in events:
+            room_state.apply(event)
+        self._rooms[room_id] = room_state
+        self._rooms.move_to_end(room_id)
+        while len(self._rooms) > self.max_size:
+            self._rooms.popitem(last=False)
+
+    def apply(self, room_id: RoomID, event: Dict[str, Any]) -> bool:
+        """Apply a single state event to a cached room. Returns False if the room isn't cached."""
+        room_state = self._rooms.get(room_id)
+        if room_state is None:
+            events = self._fetching.get(room_id)
+            if events is not None:
+                events.append(event)
+            return False
+        room_state.apply(event)
+        return True
+
+    def clear(self) -> None:
+        self._rooms.clear()
+        for room_id in self._fetching:
+            self._fetching[room_id] = None
+
+    def invalidate(self, room_id: RoomID) -> None:
+        self._rooms.pop(room_id, None)
+        if room_id in self._fetching:
+            self._fetching[room_id] = None
+
+    def invalidate_event(self, room_id: RoomID, event_id: str) -> None:
+        """Drop a cached room if it contains the given state event, e.g. after a redaction."""
+        room_state = self._rooms.get(room_id)
+        if room_state is not None and room_state.contains_event(event_id):
+            del self._rooms[room_id]
+        elif room_id in self._fetching:
+            # The response may still hold the event unredacted
+            self._fetching[room_id] = None
+
+    def stats(self) -> Dict[str, Any]:
+        lookups = self.hits + self.misses
+        return {
+            "size": len(self._rooms),
+            "max_size": self.max_size,
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_ratio": self.hits / lookups if lookups else 0.0,
+        }
@@ -0,0 +1,85 @@
+import asyncio
+from mautrix.types import RoomID
+from typing import Any, Dict, Tuple
+from typing import TYPE_CHECKING
+
+from announcement.queu_processor import NORMAL_PRIORITY
+
+if TYPE_CHECKING:
+    from announcement.bot import Announcement
+
+
+class StatePropagator:
+    """Debounces name/topic/avatar changes per announcement room and fans them out to receiver rooms.
+
+    Changes arriving within `state_debounce` seconds of each other are merged,
+    so each receiver room gets at most one update per state type. Updates go
+    through the queue processor, and rooms that were last sent the same value
+    are skipped. The values sent are remembered in memory only, so the first
+    change after a restart goes to every room.
+    """
+
+    def __init__(self, announcement: 'Announcement'):
+        self.announcement = announcement
+        self.log = announcement.log
+        self.debounce = announcement.config.get("state_debounce", 2)
+        self._pending: Dict[RoomID, Dict[str, Dict[str, Any]]] = {}
+        self._timers: Dict[RoomID, asyncio.TimerHandle] = {}
+        self._tasks = set()
+        # (receiver room, state type) -> content last sent successfully
+        self._sent: Dict[Tuple[RoomID, str], Dict[str, Any]] = {}
+
+    def schedule(self, room_id: RoomID, event_type: str, content: Dict[str, Any]) -> None:
+        """Record a state change and (re)start the debounce timer of its room."""
+        self._pending.setdefault(room_id, {})[event_type] = content
+        timer = self._timers.get(room_id)
+        if timer:
+            timer.cancel()
+        self._timers[room_id] = asyncio.get_running_loop().call_later(self.debounce, self._start_flush, room_id)
+
+    def _start_flush(self, room_id: RoomID) -> None:
+        task = asyncio.create_task(self.flush(room_id))
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+
+    async def flush(self, room_id: RoomID) -> None:
+        """Queue the merged state changes of an announcement room for every receiver room."""
+        self._timers.pop(room_id, None)
+        updates = self._pending.pop(room_id, None)
+        if not updates:
+            return
+        room_manager = self.announcement.room_manager
+        queue_processor = self.announcement.queue_processor
+        try:
+            room_state = await room_manager.fetch_room_state(room_id)
+        except Exception as e:
+            self.log.error(f"Failed to fetch state of {room_id} for propagation: {e}")
+            return
+        queued = skipped = 0
+        for user in room_state.live_users:
+            receiver_room_id = await room_manager.get_existing_private_room(room_id, user)
+            if not receiver_room_id:
+                continue
+            for event_type, content in updates.items():
+                if self._sent.get((receiver_room_id, event_type)) == content:
+                    skipped += 1
+                    continue
+                queue_processor.enqueue({
+                    "room_id": receiver_room_id,
+                    "state_event": event_type,
+                    "content": content
+                }, NORMAL_PRIORITY)
+                queued += 1
+        self.log.debug(f"Propagating {', '.join(updates)} from {room_id}: {queued} queued, {skipped} up to date")
+
+    def sent(self, room_id: RoomID, event_type: str, content: Dict[str, Any]) -> None:
+        """Remember a state update the queue processor sent to a receiver room."""
+        self._sent[(room_id, event_type)] = content
+
+    def stop(self) -> None:
+        for timer in self._timers.values():
+            timer.cancel()
+        self._timers.clear()
+        self._pending.clear()
+        for task in self._tasks:
+            task.cancel()
@@ -0,0 +1,171 @@
+"""In-memory stand-in for the mautrix client used by the announcement plugin.
+
+It models joined rooms, members and room state, adds a configurable latency
+to every request, can answer sends with M_LIMIT_EXCEEDED/retry_after_ms,
+and counts every API call by endpoint.
+"""
+import asyncio
+import copy
+import itertools
+import json
+import time
+from collections import Counter
+from typing import Any, Callable, Dict, List, Optional, Tuple
+from urllib.parse import unquote
+
+from mautrix.types import EventID, EventType, RoomID, StateEvent, UserID
+
+from announcement.rate_limiter import request_error
+
+BOT_MXID = UserID("@announcement:bench.local")
+
+
+class FakeAPI:
+    """Serves the raw /rooms/{roomId}/state request RoomManager.fetch_room_state makes."""
+
+    def __init__(self, homeserver: "FakeHomeserver"):
+        self.homeserver = homeserver
+
+    async def request(self, method, path, content=None, **kwargs) -> Any:
+        path = str(path)
+        if "/rooms/" not in path or not path.endswith("/state"):
+            raise NotImplementedError(f"{method} {path}")
+        room_id = unquote(path.split("/rooms/", 1)[1].split("/", 1)[0])
+        await self.homeserver.call("state")
+        return [copy.deepcopy(event) for event in self.homeserver.rooms[room_id].values()]
+
+
+class FakeHomeserver:
+    """A fake MaubotMatrixClient backed by plain dicts."""
+
+    def __init__(self, latency: float = 0.0, rate_limit_every: int = 0, retry_after_ms: int = 50):
+        self.mxid = BOT_MXID
+        self.api = FakeAPI(self)
+        self.latency = latency
+        self.rate_limit_every = rate_limit_every
+        self.retry_after_ms = retry_after_ms
+        self.rooms: Dict[RoomID, Dict[Tuple[str, str], Dict[str, Any]]] = {}
+        self.calls: Counter = Counter()
+        self.sent: List[Tuple[RoomID, Dict[str, Any], EventID, float]] = []
+        self.rate_limited = 0
+        self.on_send: Optional[Callable[[RoomID, Dict[str, Any]], None]] = None
+        self._ids = itertools.count()
+        self._sends = 0
+
+    # Setup helpers
+
+    def add_room(self, room_id: RoomID, members: Dict[str, str],
+                 state: List[Tuple[str, str, Dict[str, Any]]] = ()) -> None:
+        self.rooms[room_id] = {}
+        for user_id, membership in members.items():
+            self.set_state(room_id, "m.room.member", user_id, {"membership": membership}, sender=user_id)
+        for event_type, state_key, content in state:
+            self.set_state(room_id, event_type, state_key, content)
+
+    def set_state(self, room_id: RoomID, event_type: str, state_key: str, content: Dict[str, Any],
+                  sender: str = BOT_MXID) -> EventID:
+        event_id = EventID(f"$state{next(self._ids)}")
+        self.rooms[room_id][(event_type, state_key)] = {
+            "type": event_type,
+            "state_key": state_key,
+            "content": content,
+            "sender": sender,
+            "event_id": event_id,
+            "room_id": room_id,
+            "origin_server_ts": int(time.time() * 1000),
+        }
+        return event_id
+
+    def reset_counters(self) -> None:
+        self.calls.clear()
+        self.sent.clear()
+        self.rate_limited = 0
+
+    async def call(self, endpoint: str) -> None:
+        self.calls[endpoint] += 1
+        await asyncio.sleep(self.latency)
+
+    # Client API used by the plugin
+
+    async def get_joined_rooms(self) -> List[RoomID]:
+        await self.call("joined_rooms")
+        return [room_id for room_id, state in self.rooms.items()
+                if state.get(("m.room.member", self.mxid), {}).get("content", {}).get("membership") == "join"]
+
+    async def get_members(self, room_id: RoomID, **kwargs) -> List[StateEvent]:
+        await self.call("members")
+        return [StateEvent.deserialize(copy.deepcopy(event))
+                for (event_type, _), event in self.rooms[room_id].items() if event_type == "m.room.member"]
+
+    async def get_joined_members(self, room_id: RoomID) -> Dict[UserID, Dict[str, Any]]:
+        await self.call("joined_members")
+        return {state_key: event["content"] for (event_type, state_key), event in self.rooms[room_id].items()
+                if event_type == "m.room.member" and event["content"].get("membership") == "join"}
+
+    async def create_room(self, invitees: List[str] = (), initial_state: List[Dict[str, Any]] = (),
+                          name: str = "", topic: str = "", **kwargs) -> RoomID:
+        await self.call("create_room")
+        room_id = RoomID(f"!room{next(self._ids)}:bench.local")
+        self.add_room(room_id, {self.mxid: "join"})
+        for user_id in invitees:
+            self.set_state(room_id, "m.room.member", user_id, {"membership": "invite"})
+        for event in initial_state:
+            self.set_state(room_id, event["type"], event.get("state_key", ""), event["content"])
+        if name:
+            self.set_state(room_id, "m.room.name", "", {"name": name})
+        if topic:
+            self.set_state(room_id, "m.room.topic", "", {"topic": topic})
+        return room_id
+
+    async def send_state_event(self, room_id: RoomID, event_type, content, state_key: str = "",
+                               **kwargs) -> EventID:
+        await self.call("send_state")
+        if hasattr(content, "serialize"):
+            content = content.serialize()
+        return self.set_state(room_id, str(event_type), state_key, content)
+
+    async def send_message_event(self, room_id: RoomID, event_type: EventType, content,
+                                 txn_id: Optional[str] = None, **kwargs) -> EventID:
+        await self.call("send")
+        self._sends += 1
+        if self.rate_limit_every and self._sends % self.rate_limit_every == 0:
+            self.rate_limited += 1
+            # Built from the response body the way the plugin's clients build it
+            raise request_error(429, json.dumps({
+                "errcode": "M_LIMIT_EXCEEDED",
+                "error": "Too Many Requests",
+                "retry_after_ms": self.retry_after_ms,
+            }))
+        if hasattr(content, "serialize"):
+            content = content.serialize()
+        event_id = EventID(f"$event{next(self._ids)}")
+        self.sent.append((room_id, content, event_id, time.perf_counter()))
+        if self.on_send:
+            self.on_send(room_id, content)
+        return event_id
+
+    async def send_message(self, room_id: RoomID, content, **kwargs) -> EventID:
+        return await self.send_message_event(room_id, EventType.ROOM_MESSAGE, content, **kwargs)
+
+    async def send_receipt(self, room_id: RoomID, event_id: EventID, receipt_type: str = "m.read") -> None:
+        await self.call("receipt")
+
+    async def redact(self, room_id: RoomID, event_id: EventID, **kwargs) -> EventID:
+        await self.call("redact")
+        return EventID(f"$redaction{next(self._ids)}")
+
+    async def get_messages(self, room_id: RoomID, **kwargs):
+        await self.call("messages")
+        return None, None, []
+
+    async def get_event(self, room_id: RoomID, event_id: EventID):
+        await self.call("event")
+        raise NotImplementedError("get_event")
+
+    async def join_room(self, room_id: RoomID, **kwargs) -> RoomID:
+        await self.call("join")
+        return room_id
+
+    async def leave_room(self, room_id: RoomID, reason: str = "", **kwargs) -> None:
+        await self.call("leave")
+        self.set_state(room_id, "m.room.member", self.mxid, {"membership": "leave"})
@@ -0,0 +1,240 @@
+"""Offline benchmarks for the announcement plugin's fan-out paths.
+
+Drives the real Announcement plugin against FakeHomeserver and reports
+homeserver API calls, time to first delivery, total time and peak memory.
+
+    python -m benchmarks.run
+    python -m benchmarks.run --sizes 10 1000 --scenarios broadcast redact --latency 2
+"""
+import argparse
+import asyncio
+import copy
+import json
+import logging
+import os
+import tempfile
+import time
+import tracemalloc
+from typing import Any, Dict, List, Optional
+
+from mautrix.types import MessageEvent, RedactionEvent, RoomID, StateEvent, UserID
+from mautrix.util.async_db import Database
+from mautrix.util.config import RecursiveDict
+from ruamel.yaml import YAML
+from ruamel.yaml.comments import CommentedMap
+
+from announcement.bot import Announcement, Config
+from announcement.db import upgrade_table
+from benchmarks.fake_homeserver import BOT_MXID, FakeHomeserver
+
+BASE_CONFIG = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "base-config.yaml")
+ADMIN = UserID("@admin:bench.local")
+ANNOUNCEMENT_ROOM = RoomID("!announcement:bench.local")
+ORIGIN_EVENT = "$origin:bench.local"
+SCENARIOS = ("broadcast-new", "broadcast", "redact", "state", "startup-cold", "startup-warm")
+
+
+def recipients(size: int) -> List[UserID]:
+    # Spread users over a few servers so per-server behaviour is exercised too
+    return [UserID(f"@user{n}:server{n % 8}.bench.local") for n in range(size)]
+
+
+def build_world(homeserver: FakeHomeserver, size: int, with_receiver_rooms: bool) -> List[UserID]:
+    users = recipients(size)
+    homeserver.add_room(ANNOUNCEMENT_ROOM, {BOT_MXID: "join", ADMIN: "join"}, [
+        ("m.room.power_levels", "", {"users": {BOT_MXID: 100, ADMIN: 100}}),
+        ("m.room.name", "", {"name": "Bench announcements"}),
+        ("m.room.topic", "", {"topic": "benchmark"}),
+        ("org.minbh.announcement", "", {"General": users, "Live": users}),
+    ])
+    if with_receiver_rooms:
+        for n, user in enumerate(users):
+            homeserver.add_room(RoomID(f"!receiver{n}:bench.local"), {BOT_MXID: "join", user: "join"}, [
+                ("org.minbh.announcement.receiver", "", {"announcement_room_id": ANNOUNCEMENT_ROOM}),
+                ("m.room.name", "", {"name": "Bench announcements 📣"}),
+                ("m.room.topic", "", {"topic": "benchmark"}),
+            ])
+    return users
+
+
+def make_config(users: List[UserID], overrides: Dict[str, Any]) -> Config:
+    yaml = YAML()
+    with open(BASE_CONFIG) as file:
+        base = yaml.load(file)
+    user_config = copy.deepcopy(base)
+    user_config["admins"] = [{"user": ADMIN, "general": list(users)}]
+    user_config["rate_limit"] = {"per_second": 1_000_000, "burst": 1_000_000, "max_backoff": 1}
+    user_config["room_creation"] = {"per_second": 1_000_000, "burst": 1_000_000, "max_retries": 5}
+    user_config["state_debounce"] = 0.01
+    user_config["widget_url"] = ""
+    for key, value in overrides.items():
+        user_config[key] = value
+    return Config(lambda: user_config, lambda: RecursiveDict(copy.deepcopy(base), CommentedMap), lambda _: None)
+
+
+async def make_plugin(homeserver: FakeHomeserver, config: Config, db_path: str) -> Announcement:
+    log = logging.getLogger("bench.plugin")
+    database = Database.create(f"sqlite:///{db_path}", upgrade_table=upgrade_table,
+                               log=logging.getLogger("bench.db"))
+    await database.start()
+    return Announcement(homeserver, asyncio.get_running_loop(), None, "bench", log, config, database,
+                        None, None, None)
+
+
+async def start_plugin(plugin: Announcement) -> None:
+    await plugin.start()
+    await plugin.reconcile_task
+
+
+async def stop_plugin(plugin: Announcement) -> None:
+    await plugin.stop()
+    await plugin.database.stop()
+
+
+def message_event(body: str = "Benchmark announcement") -> MessageEvent:
+    return MessageEvent.deserialize({
+        "type": "m.room.message", "room_id": ANNOUNCEMENT_ROOM, "sender": ADMIN, "event_id": ORIGIN_EVENT,
+        "origin_server_ts": int(time.time() * 1000), "content": {"msgtype": "m.text", "body": body},
+    })
+
+
+def redaction_event() -> RedactionEvent:
+    return RedactionEvent.deserialize({
+        "type": "m.room.redaction", "room_id": ANNOUNCEMENT_ROOM, "sender": ADMIN, "event_id": "$redaction",
+        "origin_server_ts": int(time.time() * 1000), "redacts": ORIGIN_EVENT, "content": {},
+    })
+
+
+def topic_event(topic: str) -> StateEvent:
+    return StateEvent.deserialize({
+        "type": "m.room.topic", "state_key": "", "room_id": ANNOUNCEMENT_ROOM, "sender": ADMIN,
+        "event_id": "$topic", "origin_server_ts": int(time.time() * 1000), "content": {"topic": topic},
+    })
+
+
+class Deliveries:
+    """Waits for a number of sends into receiver rooms and remembers when the first one happened."""
+
+    def __init__(self, homeserver: FakeHomeserver, expected: int):
+        self.expected = expected
+        self.count = 0
+        self.first_at: Optional[float] = None
+        self.done = asyncio.Event()
+        if expected == 0:
+            self.done.set()
+        homeserver.on_send = self.on_send
+
+    def on_send(self, room_id: RoomID, content: Dict[str, Any]) -> None:
+        if room_id == ANNOUNCEMENT_ROOM:
+            return
+        self.count += 1
+        if self.first_at is None:
+            self.first_at = time.perf_counter()
+        if self.count >= self.expected:
+            self.done.set()
+
+
+async def wait_for_calls(homeserver: FakeHomeserver, endpoint: str, expected: int, timeout: float) -> None:
+    deadline = time.perf_counter() + timeout
+    while homeserver.calls[endpoint] < expected and time.perf_counter() < deadline:
+        await asyncio.sleep(0.005)
+
+
+async def run_scenario(scenario: str, size: int, args: argparse.Namespace) -> Dict[str, Any]:
+    homeserver = FakeHomeserver(latency=args.latency / 1000, rate_limit_every=args.rate_limit_every)
+    with_receiver_rooms = scenario not in ("broadcast-new",)
+    users = build_world(homeserver, size, with_receiver_rooms)
+    config = make_config(users, {})
+    db_path = os.path.join(tempfile.mkdtemp(prefix="announcement-bench-"), "bench.db")
+    result: Dict[str, Any] = {"scenario": scenario, "size": size}
+
+    if scenario == "startup-warm":
+        # A first start fills the receiver room index; the measured start reuses it
+        plugin = await make_plugin(homeserver, config, db_path)
+        await start_plugin(plugin)
+        await stop_plugin(plugin)
+
+    plugin = await make_plugin(homeserver, config, db_path)
+    measure_startup = scenario.startswith("startup")
+    if not measure_startup:
+        await start_plugin(plugin)
+        if scenario == "redact":
+            deliveries = Deliveries(homeserver, size)
+            await plugin.handle_message_event(message_event())
+            await asyncio.wait_for(deliveries.done.wait(), args.timeout)
+            await plugin.queue_processor.forwarded_events.flush()
+
+    homeserver.reset_counters()
+    deliveries = Deliveries(homeserver, size if scenario.startswith("broadcast") else 0)
+    if args.memory:
+        tracemalloc.start()
+    started = time.perf_counter()
+    try:
+        if measure_startup:
+            await start_plugin(plugin)
+        elif scenario.startswith("broadcast"):
+            await plugin.handle_message_event(message_event())
+            await asyncio.wait_for(deliveries.done.wait(), args.timeout)
+        elif scenario == "redact":
+            await plugin.handle_message_redact_event(redaction_event())
+            await wait_for_calls(homeserver, "redact", size, args.timeout)
+        elif scenario == "state":
+            await plugin.handle_state_event(topic_event("updated benchmark topic"))
+            await wait_for_calls(homeserver, "send_state", size, args.timeout)
+        finished = time.perf_counter()
+    finally:
+        if args.memory:
+            _, peak = tracemalloc.get_traced_memory()
+            tracemalloc.stop()
+            result["peak_mib"] = round(peak / (1024 * 1024), 2)
+        await stop_plugin(plugin)
+
+    result["total_ms"] = round((finished - started) * 1000, 1)
+    if deliveries.first_at is not None:
+        result["first_delivery_ms"] = round((deliveries.first_at - started) * 1000, 1)
+    result["api_calls"] = sum(homeserver.calls.values())
+    result["calls"] = dict(sorted(homeserver.calls.items()))
+    result["rate_limited"] = homeserver.rate_limited
+    return result
+
+
+def print_report(results: List[Dict[str, Any]]) -> None:
+    header = f"{'scenario':<14} {'size':>6} {'api calls':>9} {'first ms':>9} {'total ms':>10} {'peak MiB':>9} {'429s':>5}"
+    print(header)
+    print("-" * len(header))
+    for result in results:
+        print(f"{result['scenario']:<14} {result['size']:>6} {result['api_calls']:>9} "
+              f"{result.get('first_delivery_ms', '-'):>9} {result['total_ms']:>10} "
+              f"{result.get('peak_mib', '-'):>9} {result['rate_limited']:>5}")
+        print(f"{'':<14} {'':>6} {json.dumps(result['calls'])}")
+
+
+async def main(args: argparse.Namespace) -> None:
+    results = []
+    for scenario in args.scenarios:
+        for size in args.sizes:
+            results.append(await run_scenario(scenario, size, args))
+    print_report(results)
+    if args.json:
+        with open(args.json, "w") as file:
+            json.dump(results, file, indent=2)
+
+
+def parse_args() -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--sizes", type=int, nargs="+", default=[10, 1000, 10000],
+                        help="number of recipients (and receiver rooms)")
+    parser.add_argument("--scenarios", nargs="+", choices=SCENARIOS, default=list(SCENARIOS))
+    parser.add_argument("--latency", type=float, default=0.0, help="simulated latency per API call in ms")
+    parser.add_argument("--rate-limit-every", type=int, default=0,
+                        help="answer every Nth send with M_LIMIT_EXCEEDED (0 disables)")
+    parser.add_argument("--timeout", type=float, default=600, help="per-scenario timeout in seconds")
+    parser.add_argument("--no-memory", dest="memory", action="store_false",
+                        help="skip tracemalloc peak memory tracking, which slows the run down")
+    parser.add_argument("--json", help="also write the results to this file")
+    return parser.parse_args()
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.CRITICAL)
+    asyncio.run(main(parse_args()))